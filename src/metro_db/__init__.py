@@ -1,5 +1,7 @@
 from .types import DatabaseError
 from .sqlite_db import SQLiteDB
 from .metro_db import MetroDB
+from .async_db import AsyncSQLiteDB, AsyncMetroDB
+from .sharded_db import ShardedMetroDB
 
-__all__ = ['SQLiteDB', 'DatabaseError', 'MetroDB']
+__all__ = ['SQLiteDB', 'DatabaseError', 'MetroDB', 'AsyncSQLiteDB', 'AsyncMetroDB', 'ShardedMetroDB']
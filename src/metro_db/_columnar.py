@@ -0,0 +1,89 @@
+import array
+import sqlite3
+
+from .types import DatabaseError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array.array typecodes for the SQL types that can be stored contiguously
+ARRAY_TYPECODES = {
+    'INTEGER': 'q',
+    'REAL': 'd',
+}
+
+NUMPY_DTYPES = {
+    'q': 'int64',
+    'd': 'float64',
+}
+
+
+def _extend_column(column, typecode, values):
+    """Add the values to the column, returning the column (which is converted to a list if needed)"""
+    if typecode == 'd' and None in values:
+        values = [float('nan') if value is None else value for value in values]
+    try:
+        column.extend(array.array(typecode, values))
+        return column
+    except (TypeError, OverflowError):
+        # Values that can't be stored in the array (e.g. NULL integers or text) require a regular list
+        return column.tolist() + list(values)
+
+
+def select_columns(self, table, fields=None, clause='', order=[], chunk_size=10000, use_numpy=None):
+    """Run a SELECT command and return the results as a dictionary of columns.
+
+    INTEGER and REAL fields (based on field_types) are stored in array.array objects (or numpy arrays)
+    instead of one Python object per value. NULL values in REAL columns become nan. INTEGER columns
+    with NULL (or non-integer) values, and all other fields are returned as lists.
+
+    Args:
+        table (str): The name of the table
+        fields ([str]/str): List of fields (or the name of a single field) to select. If None, select all the fields.
+        clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
+        order ([str]/str): List of fields (or the name of a single field) to sort the rows by (i.e. ORDER BY)
+        chunk_size (int): Number of rows to fetch from the cursor at a time
+        use_numpy (bool|None): Whether to convert the numeric columns to numpy arrays.
+                               If None, they are converted if numpy is installed.
+
+    Returns:
+        dict: Mapping from each field name to its column
+    """
+    if fields is None:
+        fields = self.get_table_fields(table)
+    elif isinstance(fields, str):
+        fields = [fields]
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise DatabaseError('numpy is not installed', f'select_columns({table}, {fields})')
+
+    typecodes = [ARRAY_TYPECODES.get(self.get_field_type(field)) for field in fields]
+    columns = [array.array(typecode) if typecode else [] for typecode in typecodes]
+
+    query, params = self.generate_select_query(table, fields, clause, order, parameterized=True)
+    try:
+        cursor = self.raw_db.cursor()
+        cursor.row_factory = None
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for i, values in enumerate(zip(*rows)):
+                if isinstance(columns[i], array.array):
+                    columns[i] = _extend_column(columns[i], typecodes[i], values)
+                else:
+                    columns[i].extend(values)
+    except sqlite3.Error as e:
+        raise DatabaseError(str(e), query, params) from None
+
+    results = {}
+    for field, typecode, column in zip(fields, typecodes, columns):
+        if use_numpy and isinstance(column, array.array):
+            column = numpy.frombuffer(column, dtype=NUMPY_DTYPES[typecode]) if column else \
+                numpy.array([], dtype=NUMPY_DTYPES[typecode])
+        results[field] = column
+    return results
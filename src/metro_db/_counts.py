@@ -0,0 +1,75 @@
+from .types import DatabaseError
+
+# Bookkeeping table (see INTERNAL_TABLE_PREFIX) with the number of rows in each table, when maintain_counts is enabled
+COUNTS_TABLE = '_metro_row_counts'
+TRIGGER_PREFIX = '_metro_count_'
+
+
+def _trigger_names(table):
+    return f'{TRIGGER_PREFIX}{table}_insert', f'{TRIGGER_PREFIX}{table}_delete'
+
+
+def update_count_triggers(self):
+    """Create (or remove) the triggers that keep the row counts up to date, based on maintain_counts.
+
+    If a table's triggers are missing (e.g. because it was just created or restructured), its rows are recounted.
+    """
+    existing = set(self.query(f"SELECT name FROM sqlite_master WHERE type='trigger' AND name GLOB '{TRIGGER_PREFIX}*'",
+                              row_factory='value'))
+
+    if not self.maintain_counts:
+        for name in existing:
+            self.execute(f'DROP TRIGGER {name}')
+        self.execute(f'DROP TABLE IF EXISTS {COUNTS_TABLE}')
+        return
+
+    self.execute(f'CREATE TABLE IF NOT EXISTS {COUNTS_TABLE} (table_name TEXT PRIMARY KEY, row_count INTEGER)')
+    declared = set()
+    for table in self.tables:
+        insert_trigger, delete_trigger = _trigger_names(table)
+        declared.update([insert_trigger, delete_trigger])
+        if insert_trigger in existing and delete_trigger in existing:
+            continue
+
+        self.execute(f'DROP TRIGGER IF EXISTS {insert_trigger}')
+        self.execute(f'DROP TRIGGER IF EXISTS {delete_trigger}')
+        self.execute(f'CREATE TRIGGER {insert_trigger} AFTER INSERT ON {table} BEGIN '
+                     f"UPDATE {COUNTS_TABLE} SET row_count = row_count + 1 WHERE table_name='{table}'; END")
+        self.execute(f'CREATE TRIGGER {delete_trigger} AFTER DELETE ON {table} BEGIN '
+                     f"UPDATE {COUNTS_TABLE} SET row_count = row_count - 1 WHERE table_name='{table}'; END")
+        self.execute(f'INSERT OR REPLACE INTO {COUNTS_TABLE} (table_name, row_count) '
+                     f'SELECT ?, COUNT(*) FROM {table}', (table,))
+
+    for name in existing - declared:
+        self.execute(f'DROP TRIGGER {name}')
+    self.execute(f'DELETE FROM {COUNTS_TABLE} WHERE table_name NOT IN ({", ".join("?" * len(self.tables))})',
+                 list(self.tables))
+
+
+def get_maintained_count(self, table):
+    """Return the maintained number of rows in the table, or None if it is not available"""
+    if not self.maintain_counts or table not in self.tables:
+        return None
+    try:
+        return self.query_one(f'SELECT row_count FROM {COUNTS_TABLE} WHERE table_name=?', (table,),
+                              row_factory='value')
+    except DatabaseError:
+        # The counts table is created by update_database_structure
+        return None
+
+
+def get_approximate_count(self, table):
+    """Return an estimate of the number of rows in the table, without scanning it.
+
+    The estimate comes from the statistics gathered by ANALYZE (sqlite_stat1) if available,
+    and otherwise the largest rowid.
+    """
+    try:
+        stat = self.query_one('SELECT stat FROM sqlite_stat1 WHERE tbl=? LIMIT 1', (table.split('.')[-1],),
+                              row_factory='value')
+        if stat:
+            return int(stat.split()[0])
+    except DatabaseError:
+        # sqlite_stat1 only exists once ANALYZE has been run
+        pass
+    return self.query_one(f'SELECT MAX(rowid) FROM {table}', row_factory='value') or 0
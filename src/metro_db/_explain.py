@@ -0,0 +1,109 @@
+import logging
+import re
+
+from .types import DatabaseError, LRUCache
+
+logger = logging.getLogger('metro_db')
+
+# A step of a query plan that reads every row of a table, i.e. without an index.
+# Before sqlite 3.36, the detail was SCAN TABLE name instead of SCAN name
+FULL_SCAN = re.compile(r'SCAN (?:TABLE )?(\S+)(?: AS \S+)?$')
+
+
+def get_query_plan(self, query, params=()):
+    """Run EXPLAIN QUERY PLAN for a query (or command) and return the plan as a tree
+
+    Args:
+        query (str): SQL query to explain
+        params (tuple): values to substitute into the placeholders
+
+    Returns:
+        list: The top level steps of the plan. Each is a dictionary with the id, parent id, detail (str)
+              and children (list of steps)
+    """
+    nodes = {}
+    roots = []
+    for node_id, parent, _, detail in self.query(f'EXPLAIN QUERY PLAN {query}', params, row_factory='tuple'):
+        node = nodes[node_id] = {'id': node_id, 'parent': parent, 'detail': detail, 'children': []}
+        if parent in nodes:
+            nodes[parent]['children'].append(node)
+        else:
+            roots.append(node)
+    return roots
+
+
+def explain(self, table, fields=[], clause='', order=[], grouping=[]):
+    """Return the query plan for the query that select would run with the same arguments (see get_query_plan)
+
+    Args:
+        table (str): The name of the table
+        fields ([str]/str): List of fields (or the name of a single field) to select
+        clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
+        order ([str]/str): List of fields (or the name of a single field) to sort the rows by (i.e. ORDER BY)
+        grouping ([str]/str): List of fields (or the name of a single field) to group the rows by (i.e. GROUP BY)
+
+    Returns:
+        list: The top level steps of the plan
+    """
+    query, params = self.generate_select_query(table, fields, clause, order, grouping, parameterized=True)
+    return self.get_query_plan(query, params)
+
+
+def _iterate_plan(nodes):
+    for node in nodes:
+        yield node
+        yield from _iterate_plan(node['children'])
+
+
+def is_full_scan(table, plan):
+    """Return whether the query plan (see get_query_plan) reads every row of the table"""
+    name = table.split('.')[-1].lower()
+    for node in _iterate_plan(plan):
+        m = FULL_SCAN.match(node['detail'])
+        if m and m.group(1).lower() == name:
+            return True
+    return False
+
+
+def enable_strict_mode(self, min_rows=1000, raise_errors=False):
+    """Check the plans of the queries run by select, select_one, lookup, count, update and delete with a clause,
+    and warn about (or raise an error for) any that scan every row of a large table.
+
+    Warnings are logged to the metro_db logger. The plan for each query is only computed the first time it is run.
+
+    Args:
+        min_rows (int): Full scans are only reported for tables with at least this many rows (by approximate count)
+        raise_errors (bool): If true, raise a DatabaseError instead of logging a warning
+    """
+    self.strict_mode = {'min_rows': min_rows, 'raise_errors': raise_errors, 'scans': LRUCache(1024)}
+
+
+def disable_strict_mode(self):
+    """Stop checking the query plans"""
+    self.strict_mode = None
+
+
+def check_full_scan(self, table, query, params=()):
+    """If strict mode is enabled, check whether the query scans every row of the table.
+
+    Args:
+        table (str): The name of the table
+        query (str): SQL query (or command) that will be run
+        params (tuple): values to substitute into the placeholders
+    """
+    scans = self.strict_mode['scans']
+    scanned = scans.get(query)
+    if scanned is None:
+        scanned = is_full_scan(table, self.get_query_plan(query, params))
+        scans[query] = scanned
+
+    if not scanned:
+        return
+    num_rows = self.count(table, approximate=True)
+    if num_rows < self.strict_mode['min_rows']:
+        return
+
+    message = f'Full scan of {table} ({num_rows} rows)'
+    if self.strict_mode['raise_errors']:
+        raise DatabaseError(message, query, params)
+    logger.warning('%s: %s', message, query)
@@ -0,0 +1,157 @@
+import re
+
+from .types import DatabaseError
+
+INDEX_PATTERN = re.compile(r'CREATE\s+(UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\S+)\s+ON\s+(\S+?)\s*\(',
+                           re.IGNORECASE)
+
+
+def _strip_quotes(name):
+    if name[0] in '"`[' and name[-1] in '"`]':
+        return name[1:-1]
+    return name
+
+
+def normalize_index(table, spec):
+    """Convert an index specification from the yaml to its full dictionary form.
+
+    Args:
+        table (str): Name of the table the index is on
+        spec (str/list/dict): Either the name of a single field (or expression), a list of fields (or expressions),
+                              or a dictionary with the key fields and optionally name, unique and where.
+
+    Returns:
+        dict: With the keys name, fields, unique and where
+    """
+    if isinstance(spec, (str, list)):
+        spec = {'fields': spec}
+    elif not isinstance(spec, dict) or 'fields' not in spec:
+        raise DatabaseError(f'Invalid index specification for table {table}: {spec}', f'normalize_index({spec})')
+
+    fields = spec['fields']
+    if isinstance(fields, str):
+        fields = [fields]
+
+    name = spec.get('name')
+    if not name:
+        pieces = [table] + [re.sub(r'\W+', '_', field).strip('_') for field in fields] + ['idx']
+        name = '_'.join(pieces)
+
+    return {
+        'name': name,
+        'fields': list(fields),
+        'unique': bool(spec.get('unique', False)),
+        'where': spec.get('where'),
+    }
+
+
+def get_index_sql(table, index):
+    """Return the CREATE INDEX command for the given (normalized) index
+
+    Args:
+        table (str): Name of the table the index is on
+        index (dict): The full dictionary form of the index
+
+    Returns:
+        str
+    """
+    unique_s = 'UNIQUE ' if index['unique'] else ''
+    fields_s = ', '.join(index['fields'])
+    command = f'CREATE {unique_s}INDEX {index["name"]} ON {table}({fields_s})'
+    if index['where']:
+        command += f' WHERE {index["where"]}'
+    return command
+
+
+def parse_index_sql(sql):
+    """Convert a CREATE INDEX command back into the full dictionary form of the index.
+
+    Args:
+        sql (str): The command, as stored in sqlite_master
+
+    Returns:
+        (str, dict): The name of the table and the index dictionary
+    """
+    match = INDEX_PATTERN.match(sql)
+    if not match:
+        raise DatabaseError('Unable to parse index', sql)
+
+    # Split the contents of the parentheses at the top-level commas
+    fields = []
+    depth = 0
+    start = match.end()
+    for i in range(match.end(), len(sql)):
+        c = sql[i]
+        if c == '(':
+            depth += 1
+        elif c == ')' and depth > 0:
+            depth -= 1
+        elif c in ',)' and depth == 0:
+            fields.append(sql[start:i].strip())
+            start = i + 1
+            if c == ')':
+                break
+
+    where = None
+    remainder = sql[start:].strip()
+    if remainder[:5].upper() == 'WHERE':
+        where = remainder[5:].strip()
+
+    index = {
+        'name': _strip_quotes(match.group(2)),
+        'fields': fields,
+        'unique': bool(match.group(1)),
+        'where': where,
+    }
+    return _strip_quotes(match.group(3)), index
+
+
+def get_sql_indexes(self):
+    """Return the indexes in the database that were created with CREATE INDEX (i.e. not the automatic ones)
+
+    Returns:
+        dict: Mapping of index names to a (table name, sql) tuple
+    """
+    existing = {}
+    for row in self.query("SELECT name, tbl_name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL",
+                          row_factory='row'):
+        existing[row['name']] = row['tbl_name'], row['sql']
+    return existing
+
+
+def update_indexes(self):
+    """Create, rebuild or drop indexes so that they match the indexes definition.
+
+    Only the tables that appear in the indexes definition are affected. Within those tables, indexes that are
+    not declared are dropped, except for those created by bulk_update.
+    """
+    if not self.indexes:
+        return
+    existing = self.get_sql_indexes()
+
+    for table, specs in self.indexes.items():
+        declared = {}
+        for spec in specs or []:
+            index = normalize_index(table, spec)
+            declared[index['name']] = get_index_sql(table, index)
+
+        for name, (index_table, sql) in existing.items():
+            if index_table == table and name not in declared and not name.startswith(f'{table}_upsert_'):
+                self.execute(f'DROP INDEX {name}')
+
+        for name, sql in declared.items():
+            if name in existing:
+                if existing[name] == (table, sql):
+                    continue
+                self.execute(f'DROP INDEX {name}')
+            self.execute(sql)
+
+
+def infer_indexes(self):
+    """Use the existing database indexes to populate the indexes definition"""
+    self.indexes = {}
+    for name, (table, sql) in self.get_sql_indexes().items():
+        if table not in self.tables:
+            continue
+        _, index = parse_index_sql(sql)
+        self.indexes.setdefault(table, []).append(index)
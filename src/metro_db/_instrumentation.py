@@ -0,0 +1,205 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+from .types import LRUCache
+
+logger = logging.getLogger('metro_db')
+
+# Patterns for turning a statement into its shape, so that statements that only differ by their values are grouped
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    """Return the shape of a statement, with literal values replaced by ? and lists of placeholders collapsed
+
+    Args:
+        query (str): SQL statement
+
+    Returns:
+        str: The normalized statement
+    """
+    shape = STRING_LITERAL.sub('?', query)
+    shape = NUMBER_LITERAL.sub('?', shape)
+    shape = PLACEHOLDER_LIST.sub('?, ...', shape)
+    return WHITESPACE.sub(' ', shape).strip()
+
+
+def _percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+class QueryStats:
+    """Timing statistics for the statements run through a database, grouped by the shape of each statement.
+
+    The count, total time and number of rows are exact. The percentiles are computed from the most recent
+    samples for each shape. Statements that take at least slow_query_threshold seconds are logged as warnings
+    to the metro_db logger.
+    """
+
+    def __init__(self, slow_query_threshold=None, hook=None, max_samples=1000):
+        """
+        Args:
+            slow_query_threshold (float|None): If specified, log statements that take at least this many seconds
+            hook (function|None): If specified, called with the statement, its parameters, the seconds it took and
+                                  the number of rows (or None if unknown) after each statement
+            max_samples (int): Number of timings to keep for each shape for computing the percentiles
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.hook = hook
+        self.max_samples = max_samples
+        # Cache of the shape of each statement
+        self.shapes = LRUCache(1024)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def record(self, query, params, seconds, rows=None):
+        """Add the timing for a statement
+
+        Args:
+            query (str): SQL statement
+            params: values that were substituted into the placeholders
+            seconds (float): The time it took to run
+            rows (int|None): The number of rows returned or affected, if known
+        """
+        if rows is not None and rows < 0:
+            # sqlite3 reports -1 rows for statements that don't modify rows
+            rows = None
+
+        shape = self.shapes.get(query)
+        if shape is None:
+            shape = normalize_query(query)
+            self.shapes[query] = shape
+
+        with self.lock:
+            entry = self.entries.get(shape)
+            if entry is None:
+                entry = self.entries[shape] = {'count': 0, 'total': 0.0, 'rows': 0,
+                                               'samples': collections.deque(maxlen=self.max_samples)}
+            entry['count'] += 1
+            entry['total'] += seconds
+            if rows is not None:
+                entry['rows'] += rows
+            entry['samples'].append(seconds)
+
+        if self.slow_query_threshold is not None and seconds >= self.slow_query_threshold:
+            logger.warning('Slow query (%.3f seconds): %s', seconds, query)
+        if self.hook:
+            self.hook(query, params, seconds, rows)
+
+    def summary(self):
+        """Return the aggregate statistics for each shape of statement, with the most total time first
+
+        Returns:
+            dict: Mapping from each shape to its count, total seconds, p50 and p99 seconds and number of rows
+        """
+        results = {}
+        with self.lock:
+            entries = sorted(self.entries.items(), key=lambda item: item[1]['total'], reverse=True)
+            for shape, entry in entries:
+                samples = sorted(entry['samples'])
+                results[shape] = {
+                    'count': entry['count'],
+                    'total': entry['total'],
+                    'p50': _percentile(samples, 0.5),
+                    'p99': _percentile(samples, 0.99),
+                    'rows': entry['rows'],
+                }
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __repr__(self):
+        return f'QueryStats({len(self.entries)} shapes)'
+
+
+class TimedCursor:
+    """Wrapper for the cursor of a query whose rows are read lazily.
+
+    The time spent running the query and reading its rows is recorded once all of the rows have been read
+    (or when the results are discarded, with the number of rows read until then).
+    """
+
+    def __init__(self, stats, cursor, query, params, seconds):
+        """
+        Args:
+            stats (QueryStats): Where to record the statistics
+            cursor (Cursor): sqlite3 cursor that has executed the query
+            query (str): SQL query
+            params: values that were substituted into the placeholders
+            seconds (float): The time it took to run the query
+        """
+        self.stats = stats
+        self.cursor = cursor
+        self.query = query
+        self.params = params
+        self.seconds = seconds
+        self.rows = 0
+        self.recorded = False
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def row_factory(self):
+        return self.cursor.row_factory
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self.cursor)
+        except StopIteration:
+            self.seconds += time.perf_counter() - start
+            self.finish()
+            raise
+        self.seconds += time.perf_counter() - start
+        self.rows += 1
+        return row
+
+    def finish(self):
+        """Record the statistics, if they have not been already"""
+        if not self.recorded:
+            self.recorded = True
+            self.stats.record(self.query, self.params, self.seconds, self.rows)
+
+    def __del__(self):
+        self.finish()
+
+
+def enable_instrumentation(self, slow_query_threshold=None, hook=None, max_samples=1000):
+    """Start recording the time taken by each statement run with query, query_one, execute and execute_many.
+
+    Args:
+        slow_query_threshold (float|None): If specified, log statements that take at least this many seconds
+        hook (function|None): If specified, called with the statement, its parameters, the seconds it took and
+                              the number of rows (or None if unknown) after each statement
+        max_samples (int): Number of timings to keep for each shape of statement for computing the percentiles
+    """
+    self.instrumentation = QueryStats(slow_query_threshold, hook, max_samples)
+
+
+def disable_instrumentation(self):
+    """Stop recording the statements, and remove the statistics"""
+    self.instrumentation = None
+
+
+def stats(self):
+    """Return the statistics recorded since enable_instrumentation was called (see QueryStats.summary)
+
+    Returns:
+        dict or None: Mapping from each shape of statement to its count, total/p50/p99 seconds and number of rows
+    """
+    if self.instrumentation is None:
+        return None
+    return self.instrumentation.summary()
@@ -0,0 +1,77 @@
+import concurrent.futures
+import functools
+import os
+
+from ._queries import _format_field_list
+from .types import DatabaseError
+
+# The read-only database for each worker process
+_worker_db = None
+
+
+def _open_worker_db(path, row_factory):
+    from .sqlite_db import SQLiteDB
+    global _worker_db
+    _worker_db = SQLiteDB(path, uri_query='mode=ro', row_factory=row_factory)
+
+
+def _map_batch(fn, query, params):
+    return fn(list(_worker_db.query(query, params)))
+
+
+def parallel_map(self, table, fn, clause='', workers=None, reduce=None, fields=None, batches=None):
+    """Apply a function to batches of a table's rows in parallel, using a pool of processes.
+
+    The table is split into ranges of rowids, and each worker process reads the rows for a range
+    with its own read-only connection. Changes are committed first so that the workers can see them.
+
+    Since the function is run in another process, it must be picklable (e.g. defined at the top level of a module)
+    and so must its result. Custom types may not be converted in the workers unless processes are forked.
+
+    Args:
+        table (str): The name of the table
+        fn (function): Function that takes a list of rows and returns a result for the batch
+        clause (str/any): Optional clause to filter the rows. A string clause must start with WHERE.
+        workers (int|None): Number of processes to use. If None, use the number of CPUs.
+        reduce (function|None): If specified, a function of two results to combine them with (like functools.reduce)
+        fields ([str]/str): List of fields (or the name of a single field) to select. If None, select all the fields.
+        batches (int|None): Number of batches to split the table into. If None, use four per worker.
+
+    Returns:
+        list: The result for each batch (in rowid order), or if reduce is specified, the combined result
+    """
+    if isinstance(clause, str):
+        clause_s = clause.strip()
+        params = ()
+        if clause_s and not clause_s.upper().startswith('WHERE'):
+            raise DatabaseError('String clauses for parallel_map must start with WHERE',
+                                f'parallel_map({table}, {clause})')
+        clause_s = clause_s[5:]
+    else:
+        clause_s, params = self.generate_clause(clause, full=False, table=table, parameterized=True)
+
+    workers = workers or os.cpu_count() or 1
+    batches = batches or workers * 4
+
+    if not self.transactions:
+        self.write()
+
+    low, high = self.query_one(f'SELECT MIN(rowid), MAX(rowid) FROM {table}', row_factory='tuple')
+    if low is None:
+        return None if reduce else []
+
+    query = f'SELECT {_format_field_list(fields)} FROM {table} WHERE rowid BETWEEN ? AND ?'
+    if clause_s:
+        query += f' AND ({clause_s})'
+
+    step = (high - low) // batches + 1
+    ranges = [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_open_worker_db,
+                                                initargs=(self.path, self.row_factory)) as pool:
+        futures = [pool.submit(_map_batch, fn, query, (start, stop) + tuple(params)) for start, stop in ranges]
+        results = [future.result() for future in futures]
+
+    if reduce:
+        return functools.reduce(reduce, results)
+    return results
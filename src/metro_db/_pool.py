@@ -0,0 +1,140 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+from .types import DatabaseError
+
+# Pragmas that only apply to the connection they are set on (rather than the database file), which affect reading
+CONNECTION_PRAGMAS = [
+    'automatic_index', 'busy_timeout', 'cache_size', 'cache_spill', 'case_sensitive_like', 'mmap_size',
+    'temp_store', 'threads',
+]
+
+
+class ConnectionPool:
+    """Read-only connections to the database file that can be shared between threads, plus a lock for the writer.
+
+    The reader connections are created as needed, up to size. When all of them are in use, threads wait for one
+    to be returned. The time spent waiting for connections (and for the writer lock) is recorded in stats.
+
+    The connection-level pragmas set with set_pragmas are applied to each reader (including ones that are
+    already open, the next time they are borrowed).
+    """
+
+    def __init__(self, database_path, size, cached_statements=128):
+        """
+        Args:
+            database_path (pathlib.Path): The database file
+            size (int): Maximum number of reader connections
+            cached_statements (int): Size of the statement cache for each connection
+        """
+        self.target = f'file:{database_path}?mode=ro'
+        self.size = size
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.pragmas = {}
+        # Incremented whenever the pragmas change, and compared with the version each reader last applied
+        self.pragma_version = 0
+        self.applied_versions = {}
+        self.stats = {
+            'readers': 0,
+            'reads': 0,
+            'read_waits': 0,
+            'read_wait_time': 0.0,
+            'writes': 0,
+            'write_waits': 0,
+            'write_wait_time': 0.0,
+        }
+
+    def _connect(self):
+        try:
+            connection = sqlite3.connect(self.target, uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+                                         cached_statements=self.cached_statements, check_same_thread=False)
+        except sqlite3.OperationalError as e:
+            raise DatabaseError(str(e), self.target) from None
+        self.connections.append(connection)
+        self.stats['readers'] = len(self.connections)
+        self._apply_pragmas(connection)
+        return connection
+
+    def set_pragmas(self, pragmas):
+        """Set the pragmas for the readers, keeping only the ones in CONNECTION_PRAGMAS
+
+        Args:
+            pragmas (dict): Mapping from pragma names to their values
+        """
+        with self.lock:
+            for name, value in pragmas.items():
+                if name.lower() in CONNECTION_PRAGMAS:
+                    self.pragmas[name.lower()] = value
+                    self.pragma_version += 1
+
+    def _apply_pragmas(self, connection):
+        version = self.pragma_version
+        for name, value in list(self.pragmas.items()):
+            try:
+                connection.execute(f'PRAGMA {name}={value}')
+            except sqlite3.Error as e:
+                raise DatabaseError(str(e), f'PRAGMA {name}={value}') from None
+        self.applied_versions[connection] = version
+
+    def _acquire(self):
+        try:
+            connection = self.idle.get_nowait()
+            with self.lock:
+                self.stats['reads'] += 1
+            return connection
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            self.stats['reads'] += 1
+            if len(self.connections) < self.size:
+                return self._connect()
+
+        start = time.perf_counter()
+        connection = self.idle.get()
+        with self.lock:
+            self.stats['read_waits'] += 1
+            self.stats['read_wait_time'] += time.perf_counter() - start
+        return connection
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Context manager that borrows a reader connection from the pool"""
+        connection = self._acquire()
+        try:
+            if self.applied_versions.get(connection) != self.pragma_version:
+                self._apply_pragmas(connection)
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Context manager that holds the lock for the writer connection (which can be re-entered by the same thread)"""
+        if not self.write_lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.write_lock.acquire()
+            with self.lock:
+                self.stats['write_waits'] += 1
+                self.stats['write_wait_time'] += time.perf_counter() - start
+        try:
+            with self.lock:
+                self.stats['writes'] += 1
+            yield
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.applied_versions = {}
+            self.idle = queue.LifoQueue()
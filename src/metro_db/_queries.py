@@ -1,4 +1,10 @@
-from .types import DatabaseError, FlexibleIterator
+import collections
+import itertools
+
+from .types import DatabaseError, MISSING, table_key
+
+# A compiled select query: the SQL text and the clause fields whose values fill the placeholders (in order)
+QueryTemplate = collections.namedtuple('QueryTemplate', ['sql', 'slots'])
 
 
 def format_value(self, field, value):
@@ -34,39 +40,69 @@ def format_value(self, field, value):
         return str(value)
 
 
-def generate_clause(self, clause_spec, operator='AND', full=True, table=None):
-    """Generate a string clause based on the clause spec. If full, include the keyword WHERE
+def format_param(self, field, value):
+    """Adapt a value the same way format_value does, but for use as a placeholder parameter.
 
     Args:
-        clause_spec: If a dict, the keys are the string fieldnames and the values are the values that must match.
-                     Otherwise, assume that the clause_spec is the value of the primary key
-        operator (str): Operator to link subclauses with. Default is AND.
-        full (bool): If true, includes the WHERE string at the beginning.
+        field (str): Name of the field
+        value: The value to adapt
 
     Returns:
-        str
+        The value to pass to sqlite3 in place of a ?
     """
-    if not clause_spec:
-        return ''
-    pieces = []
+    ft = self.get_field_type(field)
+
+    if ft in self.adapters:
+        value = self.adapters[ft](value)
+
+    if ft == 'TEXT' and not isinstance(value, str):
+        value = str(value)
+    return value
+
+
+def _clause_spec_as_dict(self, clause_spec, table):
     if isinstance(clause_spec, dict):
-        for key, value in clause_spec.items():
-            if value is None:
-                pieces.append(f'{key} IS NULL')
-            else:
-                pieces.append('{}={}'.format(key, self.format_value(key, value)))
+        return clause_spec
     elif not table:
         raise DatabaseError(f'Need to specify table name for clause_spec type {type(clause_spec)}',
                             f'generate_clause({clause_spec})')
     elif table not in self.primary_key_per_table:
         raise DatabaseError(f'Table {table} does not have a defined primary key', f'generate_clause({clause_spec})')
     else:
-        key = self.primary_key_per_table[table]
-        pieces.append('{}={}'.format(key, self.format_value(key, clause_spec)))
+        return {self.primary_key_per_table[table]: clause_spec}
+
+
+def generate_clause(self, clause_spec, operator='AND', full=True, table=None, parameterized=False):
+    """Generate a string clause based on the clause spec. If full, include the keyword WHERE
+
+    Args:
+        clause_spec: If a dict, the keys are the string fieldnames and the values are the values that must match.
+                     Otherwise, assume that the clause_spec is the value of the primary key
+        operator (str): Operator to link subclauses with. Default is AND.
+        full (bool): If true, includes the WHERE string at the beginning.
+        parameterized (bool): If true, the values are replaced with placeholders and returned separately
+
+    Returns:
+        str, or (str, tuple) if parameterized
+    """
+    if not clause_spec:
+        return ('', ()) if parameterized else ''
+    pieces = []
+    params = []
+    for key, value in _clause_spec_as_dict(self, clause_spec, table).items():
+        if value is None:
+            pieces.append(f'{key} IS NULL')
+        elif parameterized:
+            pieces.append(f'{key}=?')
+            params.append(self.format_param(key, value))
+        else:
+            pieces.append('{}={}'.format(key, self.format_value(key, value)))
 
     clause = f' {operator} '.join(pieces)
     if full:
-        return f'WHERE {clause}'
+        clause = f'WHERE {clause}'
+    if parameterized:
+        return clause, tuple(params)
     else:
         return clause
 
@@ -80,7 +116,13 @@ def _format_field_list(fields, no_value='*'):
         return ', '.join(fields)
 
 
-def generate_select_query(self, table, fields=[], clause='', order=[], grouping=[]):
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return value
+
+
+def generate_select_query(self, table, fields=[], clause='', order=[], grouping=[], parameterized=False):
     """Generate a string representing a select query
 
     Args:
@@ -89,15 +131,40 @@ def generate_select_query(self, table, fields=[], clause='', order=[], grouping=
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
         order ([str]/str): List of fields (or the name of a single field) to sort the rows by (i.e. ORDER BY)
         grouping ([str]/str): List of fields (or the name of a single field) to group the rows by (i.e. GROUP BY)
+        parameterized (bool): If true, clause values are replaced with placeholders and returned separately.
+                              The compiled query is cached in query_cache based on the shape of the query.
 
     Returns:
-        str
+        str, or (str, tuple) if parameterized
     """
+    if not parameterized:
+        if not isinstance(clause, str):
+            clause = self.generate_clause(clause, table=table)
+        return _build_select_query(table, fields, clause, order, grouping)
+
+    if isinstance(clause, str):
+        clause_spec = {}
+        clause_key = clause
+    else:
+        clause_spec = _clause_spec_as_dict(self, clause, table) if clause else {}
+        clause_key = tuple((key, value is None) for key, value in clause_spec.items())
+
+    key = (table, _freeze(fields), clause_key, _freeze(order), _freeze(grouping))
+    template = self.query_cache.get(key)
+    if template is None:
+        if not isinstance(clause, str):
+            clause, _ = self.generate_clause(clause_spec, parameterized=True)
+        slots = tuple(field for field, value in clause_spec.items() if value is not None)
+        template = QueryTemplate(_build_select_query(table, fields, clause, order, grouping), slots)
+        self.query_cache[key] = template
+
+    return template.sql, tuple(self.format_param(field, clause_spec[field]) for field in template.slots)
+
+
+def _build_select_query(table, fields, clause, order, grouping):
     query = 'SELECT '
     query += _format_field_list(fields)
     query += f' FROM {table} '
-    if not isinstance(clause, str):
-        clause = self.generate_clause(clause, table=table)
     query += clause
     if grouping:
         query += ' GROUP BY '
@@ -105,11 +172,10 @@ def generate_select_query(self, table, fields=[], clause='', order=[], grouping=
     if order:
         query += ' ORDER BY '
         query += _format_field_list(order)
-
     return query
 
 
-def select(self, table, fields=[], clause='', order=[], grouping=[]):
+def select(self, table, fields=[], clause='', order=[], grouping=[], row_factory=None):
     """Run a SELECT command and return the matching rows
 
     Args:
@@ -118,14 +184,18 @@ def select(self, table, fields=[], clause='', order=[], grouping=[]):
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
         order ([str]/str): List of fields (or the name of a single field) to sort the rows by (i.e. ORDER BY)
         grouping ([str]/str): List of fields (or the name of a single field) to group the rows by (i.e. GROUP BY)
+        row_factory (str|None): The type of object to return the rows as. If None, use the database's default.
 
     Returns:
         iterator: All the rows for the select command
     """
-    return self.query(self.generate_select_query(table, fields, clause, order, grouping))
+    query, params = self.generate_select_query(table, fields, clause, order, grouping, parameterized=True)
+    if self.strict_mode is not None and clause:
+        self.check_full_scan(table, query, params)
+    return self.query(query, params, row_factory)
 
 
-def select_one(self, table, fields=[], clause='', order=[], grouping=[]):
+def select_one(self, table, fields=[], clause='', order=[], grouping=[], row_factory=None):
     """Run a SELECT command and return the first matching row if available
 
     Args:
@@ -134,11 +204,15 @@ def select_one(self, table, fields=[], clause='', order=[], grouping=[]):
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
         order ([str]/str): List of fields (or the name of a single field) to sort the rows by (i.e. ORDER BY)
         grouping ([str]/str): List of fields (or the name of a single field) to group the rows by (i.e. GROUP BY)
+        row_factory (str|None): The type of object to return the row as. If None, use the database's default.
 
     Returns:
         Row or None
     """
-    return self.query_one(self.generate_select_query(table, fields, clause, order, grouping))
+    query, params = self.generate_select_query(table, fields, clause, order, grouping, parameterized=True)
+    if self.strict_mode is not None and clause:
+        self.check_full_scan(table, query, params)
+    return self.query_one(query, params, row_factory)
 
 
 def lookup_all(self, field, table, clause='', distinct=False):
@@ -154,7 +228,15 @@ def lookup_all(self, field, table, clause='', distinct=False):
         iterator: All the values that match the query
     """
     field_s = field if not distinct else f'DISTINCT {field}'
-    return FlexibleIterator(row[0] for row in self.select(table, [field_s], clause))
+    return self.select(table, [field_s], clause, row_factory='value')
+
+
+def _result_cache_for(self, table):
+    """Return the result cache if the results of queries on the table should be cached (otherwise None)"""
+    if self.result_cache is None:
+        return None
+    elif self.result_cache_tables is None or table_key(table) in self.result_cache_tables:
+        return self.result_cache
 
 
 def lookup(self, field, table, clause=''):
@@ -167,21 +249,42 @@ def lookup(self, field, table, clause=''):
 
     Returns:
         The value or None"""
+    cache = _result_cache_for(self, table)
+    if cache is not None:
+        query, params = self.generate_select_query(table, [field], clause, parameterized=True)
+        key = (table_key(table), 'lookup', query, params)
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            if self.strict_mode is not None and clause:
+                self.check_full_scan(table, query, params)
+            value = self.query_one(query, params, row_factory='value')
+            cache[key] = value
+        return value
+
     result = self.select_one(table, [field], clause)
     if result:
         return result[0]
 
 
-def count(self, table, clause=''):
+def count(self, table, clause='', approximate=False):
     """Return the number of results for a given query.
 
+    Without a clause, the table is not scanned if maintain_counts is enabled (or if approximate is True).
+
     Args:
         table (str): Name of table to query
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
+        approximate (bool): If True and there is no clause, return an estimate (see get_approximate_count)
 
     Returns:
         int: Number of rows in the table (that match the clause)
     """
+    if not clause:
+        n = self.get_maintained_count(table)
+        if n is not None:
+            return n
+        elif approximate:
+            return self.get_approximate_count(table)
     return self.lookup('COUNT(*)', table, clause)
 
 
@@ -198,11 +301,21 @@ def dict_lookup(self, key_field, value_field, table, clause=''):
         dict: All of the rows returned by the query formatted into a dictionary
 
     """
+    cache = _result_cache_for(self, table)
+    if cache is not None:
+        query, params = self.generate_select_query(table, [key_field, value_field], clause, parameterized=True)
+        key = (table_key(table), 'dict_lookup', query, params)
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            value = {d[0]: d[1] for d in self.query(query, params, row_factory='tuple')}
+            cache[key] = value
+        return dict(value)
+
     results = self.select(table, [key_field, value_field], clause)
-    return {d[key_field]: d[value_field] for d in results}
+    return {d[0]: d[1] for d in results}
 
 
-def table_as_dict(self, table, key_field='id', fields=None, clause=''):
+def table_as_dict(self, table, key_field='id', fields=None, clause='', row_factory=None):
     """Return a dictionary mapping the key_field to the row for some query.
 
     Args:
@@ -210,6 +323,7 @@ def table_as_dict(self, table, key_field='id', fields=None, clause=''):
         key_field (str): The name of the field that should be the key in the dictionary
         fields ([str], None): A list of fields for the rows, or if None, use *
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
+        row_factory (str|None): The type of object to return the rows as. If None, use the database's default.
 
     Returns:
         dict: All of the rows returned by the query formatted into a dictionary
@@ -218,8 +332,36 @@ def table_as_dict(self, table, key_field='id', fields=None, clause=''):
     if fields and key_field not in fields:
         fields.append(key_field)
 
-    results = self.select(table, fields, clause)
-    return {d[key_field]: d for d in results}
+    query, params = self.generate_select_query(table, fields, clause, parameterized=True)
+
+    cache = _result_cache_for(self, table)
+    if cache is not None:
+        key = (table_key(table), 'table_as_dict', query, params, key_field, row_factory or self.row_factory)
+        value = cache.get(key, MISSING)
+        if value is MISSING:
+            if self.strict_mode is not None and clause:
+                self.check_full_scan(table, query, params)
+            value = _rows_by_key(self, query, params, key_field, row_factory)
+            cache[key] = value
+        return dict(value)
+
+    if self.strict_mode is not None and clause:
+        self.check_full_scan(table, query, params)
+    return _rows_by_key(self, query, params, key_field, row_factory)
+
+
+def _rows_by_key(self, query, params, field, row_factory):
+    """Run the query and return a dictionary mapping the value of the field to each row.
+
+    The field is looked up by its position in the columns sqlite reports for the query, since not every row type
+    can be indexed by name, and the table's fields can be in a different order than the physical columns
+    (e.g. columns added with ALTER TABLE go at the end).
+    """
+    results = self.query(query, params, row_factory)
+    if field not in results.columns:
+        raise DatabaseError(f'Unknown key field {field}', query, params)
+    key_index = results.columns.index(field)
+    return {d[key_index]: d for d in results}
 
 
 def unique_counts(self, table, ident_field):
@@ -274,7 +416,7 @@ def insert(self, table, row_dict):
         int: the lastrowid (i.e. probably the primary key of the inserted row)
     """
     n = len(row_dict)
-    if n > len(self.tables[table]):
+    if n > len(self.get_table_fields(table)):
         raise DatabaseError('Too many values in dictionary', f'insert({table}, {row_dict})')
     keys = row_dict.keys()
 
@@ -282,23 +424,52 @@ def insert(self, table, row_dict):
     key_s = ', '.join(keys)
 
     cur = self.execute(f'INSERT INTO {table} ({key_s}) VALUES({self.q_strings[n]})', values)
+    self.count_writes(1)
     return cur.lastrowid
 
 
-def bulk_insert(self, table, fields, rows):
+def bulk_insert(self, table, fields, rows, chunk_size=10000, commit_every=None, progress=None):
     """Insert multiple rows into the table at a time
 
+    The rows are inserted in chunks, so rows can be any iterable (e.g. a generator reading from a file)
+    without all of the rows being loaded into memory.
+
     Args:
         table (str): The name of the table to insert into
         fields (str[]): The names of the fields
-        rows (tuple[]): Each tuple is the values for the fields.
-                        The length of each tuple should match the length of fields
+        rows (iterable of tuples): Each tuple is the values for the fields.
+                                   The length of each tuple should match the length of fields
+        chunk_size (int|None): Maximum number of rows to insert with each command. If None, insert all at once.
+        commit_every (int|None): If specified, commit after (at least) this many rows have been inserted
+        progress (function|None): If specified, called after each chunk with the number of rows inserted so far
+
+    Returns:
+        int: The number of rows inserted
     """
     n = len(fields)
-    if n > len(self.tables[table]):
+    if n > len(self.get_table_fields(table)):
         raise DatabaseError('Too many values in dictionary', f'bulk_insert({table}, {fields}, ...)')
     key_s = ', '.join(fields)
-    self.execute_many(f'INSERT INTO {table} ({key_s}) VALUES({self.q_strings[n]})', rows)
+    command = f'INSERT INTO {table} ({key_s}) VALUES({self.q_strings[n]})'
+
+    total = 0
+    uncommitted = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        self.execute_many(command, chunk)
+        self.count_writes(len(chunk))
+        total += len(chunk)
+        uncommitted += len(chunk)
+
+        if commit_every is not None and uncommitted >= commit_every:
+            self.commit_batch()
+            uncommitted = 0
+        if progress:
+            progress(total)
+    return total
 
 
 def update(self, table, row_dict, replace_key='id'):
@@ -314,15 +485,15 @@ def update(self, table, row_dict, replace_key='id'):
         int: The row id of the new or old row (emulating lastrowid)
     """
     if isinstance(replace_key, str):
-        clause = self.generate_clause({replace_key: row_dict[replace_key]})
+        clause_spec = {replace_key: row_dict[replace_key]}
     else:
-        clause = self.generate_clause({key: row_dict[key] for key in replace_key})
+        clause_spec = {key: row_dict[key] for key in replace_key}
 
-    existing = self.select_one(table, clause=clause)
+    existing = self.select_one(table, clause=clause_spec, row_factory='row')
     if not existing:
         # If no matches, just insert
         self.insert(table, row_dict)
-        existing = self.select_one(table, clause=clause)
+        existing = self.select_one(table, clause=clause_spec, row_factory='row')
     else:
         field_qs = []
         values = []
@@ -336,8 +507,10 @@ def update(self, table, row_dict, replace_key='id'):
 
         if field_qs:
             field_s = ', '.join(field_qs)
+            clause, clause_params = self.generate_clause(clause_spec, parameterized=True)
             query = f'UPDATE {table} SET {field_s} ' + clause
-            self.execute(query, values)
+            cur = self.execute(query, values + list(clause_params))
+            self.count_writes(cur.rowcount)
 
     # Determine proper return
     if table not in self.primary_key_per_table:
@@ -351,6 +524,54 @@ def update(self, table, row_dict, replace_key='id'):
         return existing[return_key]
 
 
+def _has_unique_index(self, table, keys):
+    """Return whether the table has a (non-partial) unique index over exactly the given keys"""
+    for index_name in self.lookup_all('name', f'pragma_index_list("{table}")', 'WHERE "unique" AND NOT partial'):
+        if set(self.lookup_all('name', f'pragma_index_info("{index_name}")')) == set(keys):
+            return True
+    return False
+
+
+def bulk_update(self, table, fields, rows, replace_key='id'):
+    """Insert multiple rows at a time, updating the existing rows where the replace_key values match instead.
+
+    Unlike update, this is done in a single command using sqlite's upsert syntax (INSERT ... ON CONFLICT).
+    The conflict target needs a unique index, so one is created over the replace_key fields if needed.
+
+    Args:
+        table (str): The name of the table
+        fields (str[]): The names of the fields
+        rows (tuple[]): Each tuple is the values for the fields.
+                        The length of each tuple should match the length of fields
+        replace_key (str/list): The name of the field (or list of field names) that has to match
+                                for a row to be updated instead of inserted.
+    """
+    n = len(fields)
+    if n > len(self.get_table_fields(table)):
+        raise DatabaseError('Too many values in dictionary', f'bulk_update({table}, {fields}, ...)')
+
+    keys = [replace_key] if isinstance(replace_key, str) else list(replace_key)
+    missing = [key for key in keys if key not in fields]
+    if missing:
+        raise DatabaseError(f'Fields are missing replace_key values: {missing}', f'bulk_update({table}, {fields}, ...)')
+
+    key_s = ', '.join(keys)
+    if keys != [self.primary_key_per_table.get(table)] and not _has_unique_index(self, table, keys):
+        index_name = '_'.join([table, 'upsert'] + keys)
+        self.execute(f'CREATE UNIQUE INDEX {index_name} ON {table}({key_s})')
+
+    updates = [f'{field}=excluded.{field}' for field in fields if field not in keys]
+    if updates:
+        action = 'DO UPDATE SET ' + ', '.join(updates)
+    else:
+        action = 'DO NOTHING'
+
+    field_s = ', '.join(fields)
+    cur = self.execute_many(f'INSERT INTO {table} ({field_s}) VALUES({self.q_strings[n]}) '
+                            f'ON CONFLICT({key_s}) {action}', rows)
+    self.count_writes(cur.rowcount)
+
+
 def unique_insert(self, table, row_dict):
     """If there's a row where ALL the values match the row_dict's value, do nothing. Otherwise, insert it.
 
@@ -364,6 +585,59 @@ def unique_insert(self, table, row_dict):
     return self.update(table, row_dict, row_dict.keys())
 
 
+def bulk_unique_insert(self, table, fields, rows, return_ids=False):
+    """Insert each of the rows, unless there's already a row where ALL the values match.
+
+    The rows are staged into a temporary table so that the matching is done in a single query.
+
+    Args:
+        table (str): The name of the table
+        fields (str[]): The names of the fields
+        rows (tuple[]): Each tuple is the values for the fields.
+                        The length of each tuple should match the length of fields
+        return_ids (bool): If true, return the primary key value for each of the rows
+
+    Returns:
+        dict or None: If return_ids, a mapping from each row (as a tuple) to the primary key of the new or old row
+    """
+    n = len(fields)
+    if n > len(self.get_table_fields(table)):
+        raise DatabaseError('Too many values in dictionary', f'bulk_unique_insert({table}, {fields}, ...)')
+    if return_ids:
+        rows = [tuple(row) for row in rows]
+
+    staging = f'{table}_staging'
+    types_s = ', '.join(f'{field} {self.get_field_type(field)}' for field in fields)
+    field_s = ', '.join(fields)
+    match_s = ' AND '.join(f't.{field} IS s.{field}' for field in fields)
+
+    self.execute(f'DROP TABLE IF EXISTS temp.{staging}')
+    self.execute(f'CREATE TEMP TABLE {staging} ({types_s})')
+    self.execute_many(f'INSERT INTO temp.{staging} ({field_s}) VALUES({self.q_strings[n]})', rows)
+    # Indexing the staged rows lets the matching probe the index instead of scanning the staged rows for each row
+    self.execute(f'CREATE INDEX temp.{staging}_fields ON {staging} ({field_s})')
+
+    # EXCEPT finds the new rows (without duplicates, with NULLs matching like IS) using a single temporary b-tree.
+    # Ordering by the first staged copy of each row preserves the order they were given in.
+    first_s = ' AND '.join(f'n.{field} IS s.{field}' for field in fields)
+    cur = self.execute(f'INSERT INTO {table} ({field_s}) SELECT {field_s} FROM '
+                       f'(SELECT {field_s} FROM temp.{staging} EXCEPT SELECT {field_s} FROM {table}) n '
+                       f'ORDER BY (SELECT MIN(s.rowid) FROM temp.{staging} s WHERE {first_s})')
+    self.count_writes(cur.rowcount)
+
+    ids = None
+    if return_ids and table in self.primary_key_per_table:
+        key = self.primary_key_per_table[table]
+        # The CROSS JOIN scans the table once, looking up each row in the index of staged rows
+        results = self.query(f'SELECT MIN(t.{key}) FROM {table} t CROSS JOIN temp.{staging} s ON {match_s} '
+                             'GROUP BY s.rowid ORDER BY s.rowid')
+        # All of the results are read before the staging table is dropped
+        ids = dict(zip(rows, [result[0] for result in results]))
+
+    self.execute(f'DROP TABLE temp.{staging}')
+    return ids
+
+
 def delete(self, table, clause=''):
     """Run a DELETE command with the specified table.
 
@@ -371,10 +645,14 @@ def delete(self, table, clause=''):
         table (str): The name of the table
         clause (str/any): Optional clause to add to command. Use generate_clause to translate to str as needed.
     """
-
+    params = ()
     if not isinstance(clause, str):
-        clause = self.generate_clause(clause, table=table)
-    self.execute(f'DELETE FROM {table} {clause}')
+        clause, params = self.generate_clause(clause, table=table, parameterized=True)
+    command = f'DELETE FROM {table} {clause}'
+    if self.strict_mode is not None and clause:
+        self.check_full_scan(table, command, params)
+    cur = self.execute(command, params)
+    self.count_writes(cur.rowcount)
 
 
 def delete_duplicates(self, table, fields, clause=None, key_field='id'):
@@ -386,6 +664,7 @@ def delete_duplicates(self, table, fields, clause=None, key_field='id'):
         clause (str/any): Optional clause to add to query. Use generate_clause to translate to str as needed.
         key_field (str): The name of the unique field to be used for identifying individual rows.
     """
-    sub_query = self.generate_select_query(table, f'MIN({key_field})', clause=clause, grouping=fields)
+    sub_query, params = self.generate_select_query(table, f'MIN({key_field})', clause=clause, grouping=fields,
+                                                   parameterized=True)
 
-    self.delete(table, f'WHERE {key_field} NOT IN ({sub_query})')
+    self.execute(f'DELETE FROM {table} WHERE {key_field} NOT IN ({sub_query})', params)
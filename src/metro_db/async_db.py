@@ -0,0 +1,303 @@
+import asyncio
+import collections
+import functools
+import itertools
+import operator
+import queue
+import sqlite3
+import threading
+
+from .metro_db import MetroDB
+from .sqlite_db import SQLiteDB
+
+# Methods that return their results directly
+READ_METHODS = [
+    'query_one', 'select_one', 'lookup', 'count', 'dict_lookup', 'unique_counts', 'sum', 'sum_counts',
+    'table_as_dict', 'select_columns', 'get_pragma', 'get_schema_fingerprint',
+]
+
+# Methods that (may) change the database, whose results are returned once they have been committed
+WRITE_METHODS = [
+    'execute', 'execute_many', 'insert', 'bulk_insert', 'update', 'bulk_update', 'unique_insert',
+    'bulk_unique_insert', 'delete', 'delete_duplicates', 'update_database_structure', 'reset', 'set_pragmas',
+]
+
+# Methods that return an iterator, whose results are streamed back in chunks
+STREAMING_METHODS = ['query', 'select', 'lookup_all']
+
+
+def _resolve(loop, future, result=None, error=None):
+    """Set the result of the future from the worker thread"""
+    if future is None:
+        return
+    loop.call_soon_threadsafe(_set_future, future, result, error)
+
+
+def _set_future(future, result, error):
+    if future.cancelled():
+        return
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class AsyncResults:
+    """The results of a query, which can be iterated over with async for, or awaited to get all of them as a list.
+
+    The query runs in the worker thread, and the rows are retrieved chunk_size at a time.
+    """
+
+    def __init__(self, adb, method):
+        self.adb = adb
+        self.method = method
+        self.key = None
+        self.buffer = collections.deque()
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.buffer and not self.done:
+            if self.key is None:
+                self.key = next(self.adb.keys)
+                chunk = await self.adb._submit(functools.partial(self.adb._start_iterator, self.key, self.method))
+            else:
+                chunk = await self.adb._submit(functools.partial(self.adb._next_chunk, self.key))
+            self.buffer.extend(chunk)
+            if len(chunk) < self.adb.chunk_size:
+                self.done = True
+        if not self.buffer:
+            raise StopAsyncIteration
+        return self.buffer.popleft()
+
+    def __await__(self):
+        return self.adb._submit(lambda db: list(self.method(db))).__await__()
+
+    async def aclose(self):
+        """Stop iterating, releasing the cursor in the worker thread"""
+        self.close()
+
+    def close(self):
+        if self.key is not None and not self.done:
+            self.done = True
+            self.adb.requests.put((functools.partial(self.adb._close_iterator, self.key), 'read', None, None))
+
+    def __del__(self):
+        self.close()
+
+
+class AsyncSQLiteDB:
+    """Asyncio front end for SQLiteDB
+
+    The database is owned by a dedicated worker thread, which runs the requests from a queue one at a time,
+    so the event loop is never blocked. Writes from all of the coroutines are grouped into shared transactions,
+    which are committed whenever the queue is empty (or after max_batch writes). If a write raises an exception,
+    its changes are rolled back without affecting the other writes in the transaction.
+    A write's result is returned once its transaction has been committed.
+
+    The constructor takes the same arguments as the database class, plus the following.
+
+    Args:
+        chunk_size (int): Number of rows to send back at a time when iterating over query results
+        max_batch (int): Maximum number of write requests to group into one transaction
+    """
+    db_class = SQLiteDB
+
+    def __init__(self, *args, chunk_size=1000, max_batch=1000, **kwargs):
+        self.chunk_size = chunk_size
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.keys = itertools.count()
+        self.iterators = {}
+        self.db = None
+        self.error = None
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._work, args=(args, kwargs, ready), name='metro_db', daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.error:
+            raise self.error
+
+    def _work(self, args, kwargs, ready):
+        """Main loop of the worker thread"""
+        try:
+            self.db = self.db_class(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+        ready.set()
+        if self.error:
+            return
+
+        # Successful writes waiting for the next commit
+        pending = []
+        while True:
+            try:
+                fn, kind, loop, future = self.requests.get(block=not pending)
+            except queue.Empty:
+                self._commit(pending)
+                continue
+
+            if kind == 'stop':
+                self._commit(pending)
+
+            if kind == 'write':
+                result, error = self._run_write(fn)
+            else:
+                try:
+                    result, error = fn(self.db), None
+                except Exception as e:
+                    result, error = None, e
+
+            if kind == 'write' and error is None:
+                pending.append((loop, future, result))
+                if len(pending) >= self.max_batch:
+                    self._commit(pending)
+            else:
+                _resolve(loop, future, result, error)
+
+            if kind == 'stop':
+                break
+
+    def _run_write(self, fn):
+        """Run a write request, rolling back its changes (and only its changes) if it raises an exception"""
+        raw_db = self.db.raw_db
+        # With other writes waiting for the commit, the request's changes are isolated with a savepoint
+        savepoint = raw_db.in_transaction
+        if savepoint:
+            raw_db.execute('SAVEPOINT metro_db_request')
+        try:
+            result = fn(self.db)
+        except Exception as e:
+            try:
+                if savepoint:
+                    raw_db.execute('ROLLBACK TO metro_db_request')
+                    raw_db.execute('RELEASE metro_db_request')
+                else:
+                    raw_db.rollback()
+            except sqlite3.OperationalError:
+                # The request already committed its changes (e.g. with commit_batch), ending the savepoint
+                pass
+            self.db.invalidate_results()
+            return None, e
+
+        if savepoint:
+            try:
+                raw_db.execute('RELEASE metro_db_request')
+            except sqlite3.OperationalError:
+                pass
+        return result, None
+
+    def _commit(self, pending):
+        error = None
+        try:
+            self.db.write()
+        except Exception as e:
+            error = e
+        for loop, future, result in pending:
+            _resolve(loop, future, result, error)
+        pending.clear()
+
+    def _submit(self, fn, kind='read'):
+        """Queue the function to be called with the database in the worker thread
+
+        Args:
+            fn (function): Function with a single parameter, the database
+            kind (str): read, write or stop
+
+        Returns:
+            asyncio.Future: The eventual result of the function
+        """
+        if not self.thread.is_alive():
+            raise RuntimeError('The database has been closed')
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requests.put((fn, kind, loop, future))
+        return future
+
+    def _start_iterator(self, key, method, db):
+        self.iterators[key] = iter(method(db))
+        return self._next_chunk(key, db)
+
+    def _next_chunk(self, key, db):
+        chunk = list(itertools.islice(self.iterators[key], self.chunk_size))
+        if len(chunk) < self.chunk_size:
+            del self.iterators[key]
+        return chunk
+
+    def _close_iterator(self, key, db):
+        self.iterators.pop(key, None)
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a function in the worker thread, i.e. fn(db, *args, **kwargs)
+
+        This can be used to configure the database or to run several commands in a single transaction.
+
+        Returns:
+            The result of the function, once any changes have been committed
+        """
+        return await self._submit(lambda db: fn(db, *args, **kwargs), 'write')
+
+    async def write(self):
+        """Wait until all of the previous writes have been committed."""
+        await self._submit(operator.methodcaller('write'), 'write')
+
+    async def close(self, print_table_sizes=True):
+        """Commit any remaining changes, close the database and stop the worker thread
+
+        Args:
+            print_table_sizes (bool): Whether to print the table sizes
+        """
+        await self._submit(operator.methodcaller('close', print_table_sizes), 'stop')
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+
+    async def dispose(self):
+        """Used in tests to close the database and remove the file."""
+        await self._submit(operator.methodcaller('dispose'), 'stop')
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        await self.close()
+
+
+def _async_method(db_class, name, kind):
+    @functools.wraps(getattr(db_class, name))
+    async def method(self, *args, **kwargs):
+        return await self._submit(operator.methodcaller(name, *args, **kwargs), kind)
+    return method
+
+
+def _streaming_method(db_class, name):
+    @functools.wraps(getattr(db_class, name))
+    def method(self, *args, **kwargs):
+        return AsyncResults(self, operator.methodcaller(name, *args, **kwargs))
+    return method
+
+
+def _add_methods(async_class, db_class, read_methods, write_methods, streaming_methods):
+    for name in read_methods:
+        setattr(async_class, name, _async_method(db_class, name, 'read'))
+    for name in write_methods:
+        setattr(async_class, name, _async_method(db_class, name, 'write'))
+    for name in streaming_methods:
+        setattr(async_class, name, _streaming_method(db_class, name))
+
+
+_add_methods(AsyncSQLiteDB, SQLiteDB, READ_METHODS, WRITE_METHODS, STREAMING_METHODS)
+
+
+class AsyncMetroDB(AsyncSQLiteDB):
+    """Asyncio front end for MetroDB (see AsyncSQLiteDB)"""
+    db_class = MetroDB
+
+    async def __aenter__(self):
+        await self.update_database_structure()
+        return self
+
+
+_add_methods(AsyncMetroDB, MetroDB, [], ['load_yaml', 'update_database_structure'], [])
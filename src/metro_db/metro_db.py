@@ -7,7 +7,8 @@ from .sqlite_db import SQLiteDB
 class MetroDB(SQLiteDB):
     """SQLiteDB that uses a yaml file to specify the database structure"""
 
-    def __init__(self, key, folder=pathlib.Path('.'), extension='db', enums_to_register=[], uri_query=None):
+    def __init__(self, key, folder=pathlib.Path('.'), extension='db', enums_to_register=[], uri_query=None,
+                 pragmas=None, row_factory='row', pool_size=0, check_same_thread=True):
         """Constructor
 
         Args:
@@ -16,8 +17,13 @@ class MetroDB(SQLiteDB):
             extension (str): The filename suffix for the database file
             enums_to_register (list): A list of enums to register
             uri_query (str|None): If specified, the query string to use in the sqlite3 URI
+            pragmas (str|dict|None): If specified, the pragmas to set on the connection (see SQLiteDB.set_pragmas)
+            row_factory (str): The type of object to return for each row (see SQLiteDB.ROW_FACTORIES)
+            pool_size (int): If positive, the number of read-only connections to share between threads
+            check_same_thread (bool): If False, the connection can be used by other threads (one at a time)
         """
-        SQLiteDB.__init__(self, folder / f'{key}.{extension}', uri_query=uri_query)
+        SQLiteDB.__init__(self, folder / f'{key}.{extension}', uri_query=uri_query, pragmas=pragmas,
+                          row_factory=row_factory, pool_size=pool_size, check_same_thread=check_same_thread)
         self.folder = folder
         self.key = key
 
@@ -49,14 +55,30 @@ class MetroDB(SQLiteDB):
         self.field_types = db_structure.get('types', db_structure.get('field_types', {}))
         self.default_type = db_structure.get('default_type', self.default_type)
         self.primary_keys = db_structure.get('primary_keys', self.primary_keys)
-
-    def update_database_structure(self):
+        self.indexes = db_structure.get('indexes', {})
+        if 'pragmas' in db_structure:
+            self.set_pragmas(db_structure['pragmas'])
+        if 'maintain_counts' in db_structure:
+            self.maintain_counts = db_structure['maintain_counts']
+        if 'result_cache' in db_structure:
+            self.enable_result_cache(**db_structure['result_cache'])
+        if 'instrumentation' in db_structure:
+            self.enable_instrumentation(**db_structure['instrumentation'])
+        if 'strict_mode' in db_structure:
+            self.enable_strict_mode(**db_structure['strict_mode'])
+
+    def update_database_structure(self, chunk_size=None, progress=None):
         """Create or update the structure of all tables.
 
-        Loads the yaml automatically if it has not been done already."""
+        Loads the yaml automatically if it has not been done already.
+
+        Args:
+            chunk_size (int|None): If tables need to be restructured, the number of rows to copy between commits
+            progress (function|None): If tables need to be restructured, the progress function
+        """
         if not self.tables:
             self.load_yaml()
-        SQLiteDB.update_database_structure(self)
+        SQLiteDB.update_database_structure(self, chunk_size, progress)
 
     def __enter__(self):
         self.update_database_structure()
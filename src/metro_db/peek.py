@@ -45,7 +45,7 @@ def main(argv=None):
         max_width = term_size.columns
     except IOError:
         max_width = None
-    for table in db.lookup_all('name', 'sqlite_master', 'WHERE type="table"'):
+    for table in db.tables:
         if args.tables and table not in args.tables:
             continue
 
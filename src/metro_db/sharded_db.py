@@ -0,0 +1,322 @@
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import pathlib
+import re
+import zlib
+
+from .metro_db import MetroDB
+from .types import DatabaseError, FlexibleIterator
+
+
+@functools.total_ordering
+class _Reversed:
+    """Wrapper for a sort key that reverses the comparisons"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _order_key(order):
+    """Return a function that computes the sort key for a row based on an ORDER BY spec.
+
+    Each item can be a field name, optionally prefixed with - or followed by ASC/DESC.
+    Like SQL, NULL values come first.
+    """
+    specs = []
+    for item in [order] if isinstance(order, str) else order:
+        item = item.strip()
+        descending = negate = False
+        if item.upper().endswith(' DESC'):
+            item, descending = item[:-5].strip(), True
+        elif item.upper().endswith(' ASC'):
+            item = item[:-4].strip()
+        if item.startswith('-'):
+            item, negate = item[1:].strip(), True
+        if not re.fullmatch(r'\w+', item):
+            raise DatabaseError('Sharded results can only be ordered by fields', f'ORDER BY {order}')
+        specs.append((item, descending, negate))
+
+    def key(row):
+        values = []
+        for field, descending, negate in specs:
+            value = row[field]
+            if negate and value is not None:
+                value = -value
+            value = (value is not None, value)
+            values.append(_Reversed(value) if descending else value)
+        return values
+    return key
+
+
+def _merge_dicts(results, table):
+    """Merge the dictionaries from each shard, raising an error if the same key comes from more than one"""
+    merged = {}
+    for result in results:
+        for key in result:
+            if key in merged:
+                raise DatabaseError(f'Key {key!r} is in more than one shard', f'{table}: {key!r}')
+        merged.update(result)
+    return merged
+
+
+def _add_counts(results):
+    total = collections.Counter()
+    for result in results:
+        for key, value in result.items():
+            total[key] += value or 0
+    return dict(total)
+
+
+class ShardedMetroDB:
+    """Several MetroDB files with the same structure, with the rows of some tables spread across them.
+
+    Each sharded table has a shard key field, and rows are stored in the shard chosen by the hash of its value.
+    Tables that are not sharded are stored in the first shard. Commands for a single row are sent to
+    one shard, and queries are run on all the relevant shards in parallel, with the results merged together.
+    """
+
+    def __init__(self, key, shard_keys, num_shards, folder=pathlib.Path('.'), extension='db', workers=None,
+                 **kwargs):
+        """Constructor
+
+        Args:
+            key (str): Name of the database. The shards are named {key}_0, {key}_1... and share {key}.yaml
+            shard_keys (dict): Mapping from the name of each sharded table to the name of its shard key field
+            num_shards (int): Number of database files to spread the tables across
+            folder (pathlib.Path): Folder for the database files and the yaml
+            extension (str): The filename suffix for the database files
+            workers (int|None): Number of threads for running queries. If None, use one per shard.
+            kwargs: Additional arguments for each MetroDB
+        """
+        self.key = key
+        self.folder = folder
+        self.shard_keys = dict(shard_keys)
+        self.shards = [MetroDB(f'{key}_{i}', folder, extension, check_same_thread=False, **kwargs)
+                       for i in range(num_shards)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers or num_shards, thread_name_prefix='metro_db')
+
+    def load_yaml(self, structure_filepath=None):
+        """Load the yaml file for every shard.
+
+        Args:
+            structure_filepath (pathlib.Path): Optional full path to the yaml file. By default, {folder}/{key}.yaml
+        """
+        structure_key = self.key if structure_filepath is None else None
+        for shard in self.shards:
+            shard.load_yaml(structure_filepath, structure_key=structure_key)
+
+    def update_database_structure(self, chunk_size=None, progress=None):
+        """Create or update the structure of all tables in every shard."""
+        if not self.shards[0].tables:
+            self.load_yaml()
+        for shard in self.shards:
+            shard.update_database_structure(chunk_size, progress)
+
+    @property
+    def tables(self):
+        return self.shards[0].tables
+
+    def get_shard(self, table, value=None):
+        """Return the shard that has the row(s) of the table where the shard key has the value
+
+        Args:
+            table (str): The name of the table
+            value: The value of the table's shard key
+
+        Returns:
+            MetroDB: The shard
+        """
+        if table not in self.shard_keys:
+            return self.shards[0]
+        return self.shards[zlib.crc32(str(value).encode()) % len(self.shards)]
+
+    def _get_row_shard(self, table, row_dict):
+        if table not in self.shard_keys:
+            return self.shards[0]
+        field = self.shard_keys[table]
+        if field not in row_dict:
+            raise DatabaseError(f'Missing shard key {field}', f'{table}: {row_dict}')
+        return self.get_shard(table, row_dict[field])
+
+    def _get_clause_shards(self, table, clause):
+        """Return the shards that could have rows matching the clause"""
+        if table not in self.shard_keys:
+            return [self.shards[0]]
+
+        field = self.shard_keys[table]
+        if isinstance(clause, dict):
+            if field in clause:
+                return [self.get_shard(table, clause[field])]
+        elif not isinstance(clause, str) and clause is not None:
+            # Primary key value
+            if self.shards[0].primary_key_per_table.get(table) == field:
+                return [self.get_shard(table, clause)]
+            # Generated primary keys are only unique within each shard, so the row can't be identified
+            raise DatabaseError(f'Cannot look up {table} by primary key, since it is sharded by {field}',
+                                f'{table}: {clause}')
+        return self.shards
+
+    def _fan_out(self, shards, method_name, *args, **kwargs):
+        """Call the method on each of the shards in parallel, returning the list of results"""
+        if len(shards) == 1:
+            return [getattr(shards[0], method_name)(*args, **kwargs)]
+        return list(self.executor.map(lambda shard: getattr(shard, method_name)(*args, **kwargs), shards))
+
+    # Single row commands
+    def insert(self, table, row_dict):
+        """Insert the given row into the table in the shard for its shard key value (see SQLiteDB.insert)"""
+        return self._get_row_shard(table, row_dict).insert(table, row_dict)
+
+    def update(self, table, row_dict, replace_key='id'):
+        """Update or insert the row in the shard for its shard key value (see SQLiteDB.update)"""
+        return self._get_row_shard(table, row_dict).update(table, row_dict, replace_key)
+
+    def unique_insert(self, table, row_dict):
+        """Insert the row unless it already exists in the shard for its shard key value (see SQLiteDB.unique_insert)"""
+        return self._get_row_shard(table, row_dict).unique_insert(table, row_dict)
+
+    def bulk_insert(self, table, fields, rows, chunk_size=10000):
+        """Insert multiple rows into the table, with each shard's rows inserted in parallel (see SQLiteDB.bulk_insert)
+
+        Returns:
+            int: The number of rows inserted
+        """
+        if table not in self.shard_keys:
+            return self.shards[0].bulk_insert(table, fields, rows, chunk_size)
+
+        index = fields.index(self.shard_keys[table])
+        shard_rows = collections.defaultdict(list)
+        for row in rows:
+            shard_rows[self.get_shard(table, row[index])].append(row)
+
+        def insert(shard):
+            return shard.bulk_insert(table, fields, shard_rows[shard], chunk_size)
+        return sum(self.executor.map(insert, list(shard_rows)))
+
+    def delete(self, table, clause=''):
+        """Delete the matching rows from all of the relevant shards"""
+        self._fan_out(self._get_clause_shards(table, clause), 'delete', table, clause)
+
+    # Queries
+    def select(self, table, fields=[], clause='', order=[], grouping=[]):
+        """Run a SELECT command on all of the relevant shards and merge the results.
+
+        If specified, the order can only include fields (which must be selected), optionally prefixed with -
+        or followed by ASC/DESC. Grouping is not supported for sharded tables.
+
+        Returns:
+            iterator: All the rows for the select command
+        """
+        shards = self._get_clause_shards(table, clause)
+        if len(shards) == 1:
+            return shards[0].select(table, fields, clause, order, grouping)
+        elif grouping:
+            raise DatabaseError('Grouping is not supported across shards', f'select({table}, ..., {grouping})')
+
+        results = self._fan_out(shards, 'select', table, fields, clause, order)
+        if order:
+            return FlexibleIterator(heapq.merge(*results, key=_order_key(order)))
+        return FlexibleIterator(itertools.chain(*results))
+
+    def select_one(self, table, fields=[], clause='', order=[], grouping=[]):
+        """Return the first matching row from the relevant shards (see select)"""
+        return next(iter(self.select(table, fields, clause, order, grouping)), None)
+
+    def lookup_all(self, field, table, clause='', distinct=False):
+        """Return the values of the field for all the matching rows in the relevant shards.
+
+        With distinct, the values are unique across all the shards.
+        """
+        field_s = field if not distinct else f'DISTINCT {field}'
+        results = itertools.chain(*self._fan_out(self._get_clause_shards(table, clause), 'select', table,
+                                                 [field_s], clause, row_factory='value'))
+        if distinct:
+            results = iter(dict.fromkeys(results))
+        return FlexibleIterator(results)
+
+    def lookup(self, field, table, clause=''):
+        """Return the first matching value from the relevant shards
+
+        When the clause could match rows in more than one shard, the field must be a field name, since expressions
+        like aggregates would only return one shard's result. Use count, sum, etc. instead.
+        """
+        shards = self._get_clause_shards(table, clause)
+        if len(shards) > 1 and not re.fullmatch(r'\w+', field.strip()):
+            raise DatabaseError('Only fields can be looked up across shards', f'lookup({field}, {table}, {clause})')
+        for value in self._fan_out(shards, 'lookup', field, table, clause):
+            if value is not None:
+                return value
+
+    def count(self, table, clause='', approximate=False):
+        """Return the total number of matching rows in all the relevant shards (see SQLiteDB.count)"""
+        return sum(self._fan_out(self._get_clause_shards(table, clause), 'count', table, clause, approximate))
+
+    def sum(self, table, value_field, clause=''):
+        """Return the total of the value_field column in all the relevant shards"""
+        results = self._fan_out(self._get_clause_shards(table, clause), 'sum', table, value_field, clause)
+        results = [result for result in results if result is not None]
+        if results:
+            return sum(results)
+
+    def dict_lookup(self, key_field, value_field, table, clause=''):
+        """Return a dictionary mapping the key_field to the value_field for the rows in all the relevant shards
+
+        Since generated primary keys are only unique within each shard, a DatabaseError is raised if the same key
+        comes from more than one shard (rather than dropping rows).
+        """
+        return _merge_dicts(self._fan_out(self._get_clause_shards(table, clause), 'dict_lookup', key_field,
+                                          value_field, table, clause), table)
+
+    def table_as_dict(self, table, key_field='id', fields=None, clause=''):
+        """Return a dictionary mapping the key_field to the row for the rows in all the relevant shards
+
+        As with dict_lookup, a DatabaseError is raised if the same key comes from more than one shard.
+        """
+        return _merge_dicts(self._fan_out(self._get_clause_shards(table, clause), 'table_as_dict', table, key_field,
+                                          fields, clause), table)
+
+    def unique_counts(self, table, ident_field):
+        """Return the values of the ident_field mapped to the number of times each appears in all the shards"""
+        return _add_counts(self._fan_out(self._get_clause_shards(table, ''), 'unique_counts', table, ident_field))
+
+    def sum_counts(self, table, value_field, ident_field):
+        """Return the values of the ident_field mapped to the sum of the value_field in all the shards"""
+        return _add_counts(self._fan_out(self._get_clause_shards(table, ''), 'sum_counts', table, value_field,
+                                         ident_field))
+
+    # Lifecycle
+    def write(self):
+        """Commit the changes to all of the shards."""
+        self._fan_out(self.shards, 'write')
+
+    def close(self, print_table_sizes=True):
+        """Write the data and close all of the shards.
+
+        Args:
+            print_table_sizes (bool): Whether to print the table sizes of each shard
+        """
+        for shard in self.shards:
+            shard.close(print_table_sizes)
+        self.executor.shutdown()
+
+    def dispose(self):
+        """Used in tests to close the shards and remove the files."""
+        for shard in self.shards:
+            shard.dispose()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        self.update_database_structure()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
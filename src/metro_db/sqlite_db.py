@@ -1,7 +1,17 @@
 import sqlite3
+import contextlib
 import datetime
-
-from .types import DatabaseError, Row, FlexibleIterator
+import hashlib
+import json
+import re
+import time
+
+from ._indexes import get_index_sql, normalize_index
+from ._instrumentation import TimedCursor
+from ._pool import ConnectionPool
+from .transaction import Transaction
+from .types import DatabaseError, Row, FlexibleIterator, QueryIterator, LRUCache, READ_QUERY, WRITTEN_TABLES
+from .types import table_key, first_value, make_row_class, make_namedtuple_class, make_record_class
 
 PYTHON_SQL_TYPE_TRANSLATION = {
     'int': 'INTEGER',
@@ -11,20 +21,69 @@ PYTHON_SQL_TYPE_TRANSLATION = {
     'bytes': 'BLOB',
 }
 
+# The types of objects that can be used to represent rows:
+#  * row - metro_db.types.Row, which behaves like a dictionary
+#  * tuple - plain tuples
+#  * namedtuple - namedtuples, generated for each set of columns
+#  * record - metro_db.types.Record classes with __slots__, generated for each set of columns
+ROW_FACTORIES = ['row', 'tuple', 'namedtuple', 'record']
+# Maximum number of generated row classes to keep
+ROW_CLASS_CACHE_SIZE = 1024
+
+# Tables used for bookkeeping start with this prefix, and are not included when inferring the structure
+INTERNAL_TABLE_PREFIX = '_metro_'
+CHECKPOINT_TABLE = INTERNAL_TABLE_PREFIX + 'checkpoints'
+
+# Altering columns in-place requires newer versions of sqlite
+CAN_RENAME_COLUMN = sqlite3.sqlite_version_info >= (3, 25, 0)
+CAN_DROP_COLUMN = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Named sets of pragmas for common workloads, see https://www.sqlite.org/pragma.html
+PRAGMA_PROFILES = {
+    'bulk_load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'temp_store': 'MEMORY',
+        'cache_size': -262144,  # 256MB
+    },
+    'read_heavy': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+        'cache_size': -65536,  # 64MB
+        'mmap_size': 268435456,  # 256MB
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+    },
+}
+
 
 class SQLiteDB:
     """Core database structure that handles base sqlite3 interactions"""
 
-    def __init__(self, database_path, default_type='str', primary_keys=['id'], uri_query=None):
+    def __init__(self, database_path, default_type='str', primary_keys=['id'], uri_query=None, query_cache_size=256,
+                 pragmas=None, row_factory='row', pool_size=0, check_same_thread=True):
         """
         Args:
             database_path (pathlib.Path): File to store the data
             default_type (str): The default SQL type to use
             primary_keys (list of strings): Fields that should automatically be marked as primary keys
             uri_query (str|None): If specified, the query string to use in the URI [1]
+            query_cache_size (int): Maximum number of compiled select queries to keep in query_cache
+            pragmas (str|dict|None): If specified, the pragmas to set on the connection (see set_pragmas)
+            row_factory (str): The type of object to return for each row: one of ROW_FACTORIES
+            pool_size (int): If positive, the database can be shared between threads, with up to this many
+                             read-only connections for queries (see ConnectionPool)
+            check_same_thread (bool): If False, the connection can be used by other threads (one at a time) [2]
 
         [1] https://docs.python.org/3/library/sqlite3.html#how-to-work-with-sqlite-uris
+        [2] https://docs.python.org/3/library/sqlite3.html#sqlite3.connect
         """
+        if row_factory not in ROW_FACTORIES:
+            raise DatabaseError(f'Unknown row factory {row_factory}', f'SQLiteDB({database_path})')
+
         if uri_query:
             self.target = f'file:{database_path}?{uri_query}'
             uri = True
@@ -32,7 +91,9 @@ class SQLiteDB:
             self.target = str(database_path)
             uri = False
         try:
-            self.raw_db = sqlite3.connect(self.target, uri=uri, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.raw_db = sqlite3.connect(self.target, uri=uri, detect_types=sqlite3.PARSE_DECLTYPES,
+                                          cached_statements=max(128, query_cache_size),
+                                          check_same_thread=check_same_thread and not pool_size)
         except sqlite3.OperationalError as e:
             raise DatabaseError(str(e), self.target) from None
         self.path = database_path
@@ -43,6 +104,7 @@ class SQLiteDB:
         self.default_type = default_type
         self.primary_keys = list(primary_keys)
         self.primary_key_per_table = {}
+        self.indexes = {}
         self.adapters = {}
         self.converters = {}
         self.register_custom_type('bool', bool, int, lambda v: bool(int(v)))
@@ -59,6 +121,36 @@ class SQLiteDB:
                                   )
 
         self.q_strings = {}
+        self.query_cache = LRUCache(query_cache_size)
+        self.transactions = []
+        self.attached_tables = {}
+        self.result_cache = None
+        self.result_cache_tables = None
+        self.row_factory = row_factory
+        # Generated classes for each row factory and set of columns, bounded so ad hoc queries don't accumulate them
+        self.row_classes = LRUCache(ROW_CLASS_CACHE_SIZE)
+        # If specified, the maximum number of rows each set of query results will keep in memory
+        self.max_cached_rows = None
+        # If enabled, the QueryStats for the statements that are run (see enable_instrumentation)
+        self.instrumentation = None
+        # If enabled, the settings for checking for full table scans (see enable_strict_mode)
+        self.strict_mode = None
+        # Whether the number of rows in each table is kept up to date with triggers (see update_count_triggers)
+        self.maintain_counts = False
+
+        if pool_size:
+            if str(database_path) == ':memory:':
+                raise DatabaseError('In-memory databases cannot be pooled', self.target)
+            self.pool = ConnectionPool(database_path, pool_size, max(128, query_cache_size))
+            self.write_lock = self.pool.writer
+            # Readers can only run alongside the writer in WAL mode
+            self.set_pragmas({'journal_mode': 'WAL'})
+        else:
+            self.pool = None
+            self.write_lock = contextlib.nullcontext
+
+        if pragmas:
+            self.set_pragmas(pragmas)
 
     def register_custom_type(self, name, type_, adapter_fn, converter_fn):
         """Register a non-standard datatype.
@@ -85,36 +177,196 @@ class SQLiteDB:
                                   lambda d: d.value,
                                   lambda v: custom_enum_class(int(v)))
 
-    def query_one(self, query):
+    def get_pragma(self, name):
+        """Return the current value of a pragma.
+
+        Args:
+            name (str): Name of the pragma
+
+        Returns:
+            The value, or None if the pragma has no value
+        """
+        row = self.query_one(f'PRAGMA {name}')
+        if row:
+            return row[0]
+
+    def set_pragmas(self, pragmas):
+        """Set pragmas on the connection (and the pool's readers). Any uncommitted changes are committed first.
+
+        Args:
+            pragmas (str|dict): Either the name of one of the PRAGMA_PROFILES, or a dictionary mapping pragma names
+                                to their values. The dictionary can also specify a profile with the key "profile",
+                                in which case the other values override the profile's values.
+
+        Returns:
+            dict: The previous values of the pragmas, which can be passed back in to restore them.
+        """
+        if isinstance(pragmas, str):
+            pragmas = {'profile': pragmas}
+        if 'profile' in pragmas:
+            profile = pragmas['profile']
+            if profile not in PRAGMA_PROFILES:
+                raise DatabaseError(f'Unknown pragma profile {profile}', f'set_pragmas({pragmas})')
+            pragmas = dict(PRAGMA_PROFILES[profile], **{k: v for k, v in pragmas.items() if k != 'profile'})
+
+        if not self.transactions:
+            self.write()
+
+        previous = {}
+        for name, value in pragmas.items():
+            previous[name] = self.get_pragma(name)
+            self.execute(f'PRAGMA {name}={value}')
+        if self.pool is not None:
+            # Connection-level pragmas like cache_size also need to be set on the readers that serve the queries
+            self.pool.set_pragmas(pragmas)
+        return previous
+
+    def enable_result_cache(self, size=1024, tables=None):
+        """Cache the results of lookup, count, dict_lookup and table_as_dict (and the methods based on them).
+
+        The cached results for a table are removed whenever a command that writes to it is run through this object.
+        Changes made by other connections (or by triggers) are not detected.
+
+        Args:
+            size (int): Maximum number of results to keep
+            tables (list|None): If specified, only cache the results from these tables
+        """
+        self.result_cache = LRUCache(size)
+        self.result_cache_tables = None if tables is None else {table_key(table) for table in tables}
+
+    def disable_result_cache(self):
+        """Stop caching results"""
+        self.result_cache = None
+        self.result_cache_tables = None
+
+    def invalidate_results(self, command=None):
+        """Remove the cached results for the tables that the command writes to.
+
+        Args:
+            command (str|None): SQL command. If None, or if the tables can't be determined, all results are removed.
+        """
+        if self.result_cache is None or (command is not None and READ_QUERY.match(command)):
+            return
+        tables = {table_key(table) for table in WRITTEN_TABLES.findall(command or '')}
+        if tables:
+            self.result_cache.discard(lambda key: key[0] in tables)
+        else:
+            self.result_cache.clear()
+
+    def get_row_factory(self, cursor, row_factory=None):
+        """Return the row_factory to use for the cursor's results
+
+        Args:
+            cursor (Cursor): sqlite3 cursor that has executed a query
+            row_factory (str|None): One of ROW_FACTORIES, or None to use the database's default
+
+        Returns:
+            The class to construct each row with, or None for tuples
+        """
+        row_factory = row_factory or self.row_factory
+        if row_factory == 'tuple':
+            return None
+        elif row_factory == 'value':
+            # Used internally for single column queries
+            return first_value
+
+        columns = tuple(d[0] for d in cursor.description)
+        key = row_factory, columns
+        row_class = self.row_classes.get(key)
+        if row_class is None:
+            if row_factory == 'row':
+                row_class = make_row_class(columns)
+            elif row_factory == 'namedtuple':
+                row_class = make_namedtuple_class(columns)
+            elif row_factory == 'record':
+                row_class = make_record_class(columns)
+            else:
+                raise DatabaseError(f'Unknown row factory {row_factory}', f'get_row_factory({row_factory})')
+            self.row_classes[key] = row_class
+        return row_class
+
+    def _use_reader(self, query):
+        """Return whether the query should be run with one of the pool's read-only connections
+
+        When the writer has uncommitted changes, queries use the writer so that the changes are visible.
+        """
+        return self.pool is not None and not self.raw_db.in_transaction and READ_QUERY.match(query)
+
+    def _run_query(self, connection, query, params, row_factory):
+        cursor = connection.cursor()
+        cursor.execute(query, params or ())
+        if cursor.description:
+            cursor.row_factory = self.get_row_factory(cursor, row_factory)
+        return cursor
+
+    def query_one(self, query, params=None, row_factory=None):
         """Run the specified query and return the first result
 
         Args:
             query (str): SQL query to execute
+            params (tuple|None): values to substitute into the placeholders
+            row_factory (str|None): The type of object to return the row as. If None, use the database's default.
 
         Returns:
             Row or None: The result of the query
         """
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
         try:
-            cursor = self.raw_db.cursor()
-            cursor.execute(query)
-            return cursor.fetchone()
+            if self._use_reader(query):
+                with self.pool.reader() as connection:
+                    row = self._run_query(connection, query, params, row_factory).fetchone()
+            else:
+                with self.write_lock():
+                    row = self._run_query(self.raw_db, query, params, row_factory).fetchone()
         except sqlite3.OperationalError as e:
-            raise DatabaseError(str(e), query) from None
+            raise DatabaseError(str(e), query, params) from None
+        if instrumentation is not None:
+            instrumentation.record(query, params, time.perf_counter() - start, int(row is not None))
+        return row
 
-    def query(self, query):
+    def query(self, query, params=None, row_factory=None):
         """Run the specified query and return the results
 
         Args:
             query (str): SQL query to execute
+            params (tuple|None): values to substitute into the placeholders
+            row_factory (str|None): The type of object to return the rows as. If None, use the database's default.
 
         Returns:
             Iterator(Row): The results of the query
         """
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
         try:
-            cursor = self.raw_db.cursor()
-            return FlexibleIterator(cursor.execute(query))
+            if self.pool is None:
+                cursor = self._run_query(self.raw_db, query, params, row_factory)
+                if instrumentation is not None and cursor.description:
+                    # The rows are read lazily, so the statistics are recorded once they have all been read
+                    cursor = TimedCursor(instrumentation, cursor, query, params, time.perf_counter() - start)
+                    instrumentation = None
+                results = QueryIterator(self, cursor, query, params, self.max_cached_rows)
+                num_rows = None if cursor.description else cursor.rowcount
+            else:
+                # With a pool, the results are read right away so that the connection can be used by other threads
+                if self._use_reader(query):
+                    with self.pool.reader() as connection:
+                        cursor = self._run_query(connection, query, params, row_factory)
+                        rows = cursor.fetchall()
+                else:
+                    with self.write_lock():
+                        cursor = self._run_query(self.raw_db, query, params, row_factory)
+                        rows = cursor.fetchall()
+                columns = [column[0] for column in cursor.description] if cursor.description else None
+                results = FlexibleIterator(iter(rows), columns)
+                num_rows = len(rows)
         except (sqlite3.Error, ValueError) as e:
-            raise DatabaseError(str(e), query) from None
+            raise DatabaseError(str(e), query, params) from None
+        if instrumentation is not None:
+            instrumentation.record(query, params, time.perf_counter() - start, num_rows)
+        return results
 
     def execute(self, command, params=()):
         """Execute the given command with the parameters. Returns the cursor
@@ -126,12 +378,20 @@ class SQLiteDB:
         Returns:
             Cursor: sqlite3 cursor for getting additional info like lastrowid
         """
+        if self.result_cache is not None:
+            self.invalidate_results(command)
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
         try:
-            cur = self.raw_db.cursor()
-            cur.execute(command, params)
-            return cur
+            with self.write_lock():
+                cur = self.raw_db.cursor()
+                cur.execute(command, params)
         except (sqlite3.Error, ValueError) as e:
             raise DatabaseError(str(e), command, params) from None
+        if instrumentation is not None:
+            instrumentation.record(command, params, time.perf_counter() - start, cur.rowcount)
+        return cur
 
     def execute_many(self, command, objects):
         """Execute the given command multiple times.
@@ -139,11 +399,23 @@ class SQLiteDB:
         Args:
             command (str): SQL command to execute
             objects (list of tuples): The given command is run for each object/set of placeholder values
+
+        Returns:
+            Cursor: sqlite3 cursor for getting additional info like rowcount
         """
+        if self.result_cache is not None:
+            self.invalidate_results(command)
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = time.perf_counter()
         try:
-            self.raw_db.executemany(command, objects)
+            with self.write_lock():
+                cur = self.raw_db.executemany(command, objects)
         except (sqlite3.Error, ValueError) as e:
             raise DatabaseError(str(e), command, objects) from None
+        if instrumentation is not None:
+            instrumentation.record(command, objects, time.perf_counter() - start, cur.rowcount)
+        return cur
 
     def get_field_type(self, field, full=False):
         """Return a string representing the type of a given field.
@@ -178,29 +450,91 @@ class SQLiteDB:
             dict[str/str]: a mapping from field name to sql
         """
         type_map = {}
-        for row in self.query(f'PRAGMA table_info("{table}")'):
+        for row in self.query(f'PRAGMA table_info("{table}")', row_factory='row'):
             type_map[row['name']] = row['type']
         return type_map
 
-    def update_database_structure(self):
-        """Create or update the structure of all tables."""
+    def get_sql_schema(self, schema_name='main'):
+        """Create a dictionary mapping each table name to the types of its fields, using a single query.
+
+        Args:
+            schema_name (str): The name of the database to read, i.e. main or the alias of an attached database
+
+        Returns:
+            dict[str/dict[str/str]]: a mapping from table name to a mapping from field name to sql type
+        """
+        schema = {}
+        for row in self.query(f"SELECT m.name AS table_name, p.name, p.type FROM {schema_name}.sqlite_master m "
+                              f"JOIN pragma_table_info(m.name, '{schema_name}') p WHERE m.type='table' "
+                              "ORDER BY m.rowid, p.cid", row_factory='row'):
+            schema.setdefault(row['table_name'], {})[row['name']] = row['type']
+        return schema
+
+    def get_schema_fingerprint(self):
+        """Return a hash of the effective database structure (tables, field types, primary keys and indexes).
+
+        Returns:
+            int: A positive 31-bit integer, suitable for storing in the user_version pragma
+        """
+        structure = {
+            'tables': {table: [[key, self.get_field_type(key, full=True)] for key in keys]
+                       for table, keys in self.tables.items()},
+            'indexes': {table: [get_index_sql(table, normalize_index(table, spec)) for spec in specs or []]
+                        for table, specs in self.indexes.items()},
+        }
+        if self.maintain_counts:
+            structure['maintain_counts'] = True
+        digest = hashlib.sha1(json.dumps(structure, sort_keys=True).encode()).digest()
+        return (int.from_bytes(digest[:4], 'big') & 0x7FFFFFFF) or 1
+
+    def update_database_structure(self, chunk_size=None, progress=None):
+        """Create or update the structure of all tables.
+
+        The fingerprint of the structure is stored in the database's user_version pragma. If it matches the current
+        fingerprint, the database was last updated with the same structure, so the tables are not checked again.
+
+        Args:
+            chunk_size (int|None): If tables need to be restructured, the number of rows to copy between commits
+            progress (function|None): If tables need to be restructured, the progress function (see restructure_table)
+        """
         self.primary_key_per_table = {}
         for table, keys in self.tables.items():
-            # Check if table exists
-            table_exists = self.count('sqlite_master', f"WHERE type='table' AND name='{table}'") > 0
-            if not table_exists:
-                self.create_table(table, keys)
-            else:
-                self.update_table(table, keys)
-
             # Save primary key
             for key in keys:
                 if key in self.primary_keys:
                     self.primary_key_per_table[table] = key
 
+            if self.row_factory == 'record':
+                self.row_classes['record', tuple(keys)] = make_record_class(keys, table.title().replace('_', ''))
+        self._register_attached_keys()
+
         if not self.tables:
             return
 
+        if self.maintain_counts:
+            # Rows removed by REPLACE only fire the count triggers' DELETE trigger when recursive triggers are on
+            self.execute('PRAGMA recursive_triggers=ON')
+
+        fingerprint = self.get_schema_fingerprint()
+        if self.get_pragma('user_version') != fingerprint:
+            self.invalidate_results()
+            schema = self.get_sql_schema()
+            for table, keys in self.tables.items():
+                if table not in schema:
+                    self.create_table(table, keys)
+                else:
+                    self.update_table(table, keys, type_map=schema[table], chunk_size=chunk_size, progress=progress)
+
+            self.update_indexes()
+            self.update_count_triggers()
+
+            try:
+                self.execute(f'PRAGMA user_version={fingerprint}')
+            except DatabaseError as e:
+                # Read-only databases can still be used, without storing the fingerprint
+                if 'readonly' not in str(e):
+                    raise
+
         # Cache strings consisting of a number of comma separated question marks
         for n in range(1, max(len(k) for k in self.tables.values()) + 1):
             self.q_strings[n] = ', '.join(['?'] * n)
@@ -219,27 +553,40 @@ class SQLiteDB:
         type_s = ', '.join(types)
         self.execute(f'CREATE TABLE {table} ({type_s})')
 
-    def update_table(self, table, keys, field_mappings={}):
+    def update_table(self, table, keys, field_mappings={}, type_map=None, chunk_size=None, progress=None):
         """Update a table to have the given keys while preserving the data.
 
         Args:
             table (str): Name of the table
             keys (str[]): Keys that the table should have after this operation
             field_mappings (dict[str/str]): Mapping of new field names to old field names.
+            type_map (dict[str/str]|None): The current types of the table's fields, if already known
+            chunk_size (int|None): If the data needs to be copied, the number of rows to copy between commits
+            progress (function|None): If the data needs to be copied, the progress function (see restructure_table)
         """
         self.tables[table] = keys
-        type_map = self.get_sql_table_types(table)
+        if type_map is None:
+            type_map = self.get_sql_table_types(table)
 
         fields_to_add = []
+        fields_to_rename = {}
         old_fields = []
         new_fields = []
         needs_restructure = False
+        mapped_fields = list(field_mappings.values())
 
         for key in keys:
             if key in field_mappings:
-                old_fields.append(field_mappings[key])
+                old_field = field_mappings[key]
+                old_fields.append(old_field)
                 new_fields.append(key)
-                needs_restructure = True
+
+                # Renaming in-place is only possible if the old field is not also being kept/copied elsewhere
+                if not CAN_RENAME_COLUMN or old_field in keys or key in type_map or \
+                        mapped_fields.count(old_field) > 1 or type_map.get(old_field) != self.get_field_type(key):
+                    needs_restructure = True
+                else:
+                    fields_to_rename[old_field] = key
             elif key in type_map:
                 old_fields.append(key)
                 new_fields.append(key)
@@ -252,40 +599,245 @@ class SQLiteDB:
                 if key in self.primary_keys:
                     needs_restructure = True
 
-        fields_to_remove = set(type_map.keys()) - set(keys)
-        needs_restructure = needs_restructure or len(fields_to_remove)
+        fields_to_remove = [field for field in type_map if field not in keys and field not in mapped_fields]
+
+        if not needs_restructure:
+            # Try to alter the table in-place. Dropping can fail (e.g. if the column is indexed), in which case the
+            # table is restructured instead. Dropped columns are not copied, so dropping them first is safe.
+            for field in fields_to_remove:
+                if not CAN_DROP_COLUMN:
+                    needs_restructure = True
+                    break
+                try:
+                    self.execute(f'ALTER TABLE {table} DROP COLUMN {field}')
+                except DatabaseError:
+                    needs_restructure = True
+                    break
 
         if not needs_restructure:
-            # Can alter the table in-place
+            for old_field, new_field in fields_to_rename.items():
+                self.execute(f'ALTER TABLE {table} RENAME COLUMN {old_field} TO {new_field}')
             for field in fields_to_add:
                 tt = self.get_field_type(field, full=True)
                 self.execute(f'ALTER TABLE {table} ADD COLUMN {field} {tt}')
             return
 
-        temp_table_name = f'{table}_x'
-        self.execute(f'ALTER TABLE {table} RENAME TO {temp_table_name}')
-        self.create_table(table, self.tables[table])
+        self.restructure_table(table, old_fields, new_fields, chunk_size, progress)
+
+    def restructure_table(self, table, old_fields, new_fields, chunk_size=None, progress=None):
+        """Copy the data into a new table with the current structure, and then swap it in for the old table.
+
+        If chunk_size is specified, the rows are copied in chunks (by rowid), committing after each one along with a
+        checkpoint. If the restructure is interrupted, calling this again with the same fields resumes from the
+        checkpoint. The old table is left untouched until the final swap, which is done in a single transaction.
+
+        Args:
+            table (str): Name of the table
+            old_fields (str[]): The names of the fields to copy from the old table
+            new_fields (str[]): The names of the fields in the new table to copy them to
+            chunk_size (int|None): If specified, the number of rows to copy between commits
+            progress (function|None): If specified, called with the table name, the number of rows copied so far
+                                      and the total number of rows after each chunk
+        """
+        new_table = f'{INTERNAL_TABLE_PREFIX}new_{table}'
+        keys = self.tables[table]
+        signature = json.dumps([old_fields, new_fields, [self.get_field_type(key, full=True) for key in keys]])
+
+        last_rowid = None
+        if chunk_size is not None:
+            self.execute(f'CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} '
+                         '(table_name TEXT PRIMARY KEY, signature TEXT, last_rowid INTEGER)')
+            checkpoint = self.query_one(f'SELECT signature, last_rowid FROM {CHECKPOINT_TABLE} WHERE table_name=?',
+                                        (table,), row_factory='row')
+            if checkpoint and checkpoint['signature'] == signature and \
+                    self.query_one('SELECT name FROM sqlite_master WHERE name=?', (new_table,)):
+                last_rowid = checkpoint['last_rowid']
+
+        if last_rowid is None:
+            self.execute(f'DROP TABLE IF EXISTS {new_table}')
+            self.create_table(new_table, keys)
+            copied = 0
+        else:
+            copied = self.count(new_table)
 
+        total = self.count(table)
         old_fields_s = ', '.join(old_fields)
         new_fields_s = ', '.join(new_fields)
-        command = f'INSERT INTO {table}({new_fields_s}) SELECT {old_fields_s} FROM {temp_table_name}'
-        self.execute(command)
-        self.execute(f'DROP TABLE {temp_table_name}')
+        command = f'INSERT INTO {new_table}({new_fields_s}) SELECT {old_fields_s} FROM {table}'
+
+        if chunk_size is None:
+            self.execute(command)
+            copied = total
+            if progress:
+                progress(table, copied, total)
+        else:
+            if last_rowid is None:
+                last_rowid = self.lookup('MIN(rowid) - 1', table) or 0
+            while True:
+                next_rowid = self.query_one(f'SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? '
+                                            'ORDER BY rowid LIMIT ?)', (last_rowid, chunk_size))[0]
+                if next_rowid is None:
+                    break
+                cur = self.execute(command + ' WHERE rowid > ? AND rowid <= ? ORDER BY rowid', (last_rowid, next_rowid))
+                copied += cur.rowcount
+                last_rowid = next_rowid
+                self.execute(f'INSERT OR REPLACE INTO {CHECKPOINT_TABLE} VALUES(?, ?, ?)',
+                             (table, signature, last_rowid))
+                self.commit_batch()
+                if progress:
+                    progress(table, copied, total)
+
+        self.execute('SAVEPOINT metro_db_swap')
+        self.execute(f'DROP TABLE {table}')
+        self.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+        if chunk_size is not None:
+            self.execute(f'DELETE FROM {CHECKPOINT_TABLE} WHERE table_name=?', (table,))
+        self.execute('RELEASE metro_db_swap')
+
+        if self.maintain_counts:
+            # The count triggers were dropped along with the old table
+            self.update_count_triggers()
 
     def infer_database_structure(self):
         """Use the existing database entries to infer the tables and field_types"""
-        for table in self.lookup_all('name', 'sqlite_master', "WHERE type='table'"):
-            type_dict = self.get_sql_table_types(table)
+        for table, type_dict in self.get_sql_schema().items():
+            if table.startswith(INTERNAL_TABLE_PREFIX):
+                continue
             self.tables[table] = list(type_dict.keys())
             for field, type_name in type_dict.items():
                 if type_name != self.default_type:
                     self.field_types[field] = type_name
+        self.infer_indexes()
+
+    def get_table_fields(self, table):
+        """Return the list of fields for a table, which may be in an attached database (i.e. alias.table)
+
+        Args:
+            table (str): The name of the table
+
+        Returns:
+            list: The names of the fields
+        """
+        if table in self.attached_tables:
+            return self.attached_tables[table]
+        elif table.startswith('main.'):
+            table = table[5:]
+        return self.tables[table]
+
+    def attach(self, other, alias):
+        """Attach another database file so that its tables can be queried as alias.table
+
+        Args:
+            other (SQLiteDB|pathlib.Path|str): The database (or the path to its file)
+            alias (str): The name to refer to the database with
+        """
+        if not re.fullmatch(r'[A-Za-z_]\w*', alias) or alias.lower() in ['main', 'temp']:
+            raise DatabaseError(f'Invalid alias {alias}', f'attach({other}, {alias})')
+        if isinstance(other, SQLiteDB):
+            path = other.path
+            field_types = other.field_types
+        else:
+            path = other
+            field_types = {}
+
+        # Databases cannot be attached inside a transaction
+        if not self.transactions:
+            self.write()
+        self.execute('ATTACH DATABASE ? AS ' + alias, (str(path),))
+
+        local_fields = {field for fields in self.tables.values() for field in fields}
+        for table, type_dict in self.get_sql_schema(alias).items():
+            if table.startswith(INTERNAL_TABLE_PREFIX):
+                continue
+            self.attached_tables[f'{alias}.{table}'] = list(type_dict.keys())
+            for field, type_name in type_dict.items():
+                if field in self.field_types or field in local_fields:
+                    continue
+                elif field in field_types:
+                    self.field_types[field] = field_types[field]
+                elif type_name != self.get_field_type(field):
+                    self.field_types[field] = type_name
+
+        self._register_attached_keys()
+        for n in range(1, max([len(fields) for fields in self.attached_tables.values()], default=0) + 1):
+            self.q_strings.setdefault(n, ', '.join(['?'] * n))
+
+    def detach(self, alias):
+        """Detach a database that was attached with attach
+
+        Args:
+            alias (str): The name of the attached database
+        """
+        if not self.transactions:
+            self.write()
+        self.execute(f'DETACH DATABASE {alias}')
+        for table in list(self.attached_tables):
+            if table.startswith(f'{alias}.'):
+                del self.attached_tables[table]
+                self.primary_key_per_table.pop(table, None)
+
+    def _register_attached_keys(self):
+        for table, keys in self.attached_tables.items():
+            for key in keys:
+                if key in self.primary_keys:
+                    self.primary_key_per_table[table] = key
+
+    def copy_table(self, src_alias, table, dest=None, fields=None, clause=''):
+        """Copy rows from a table in one database to another with a single INSERT ... SELECT command
+
+        Args:
+            src_alias (str): The name of the database to copy from (i.e. main or the alias of an attached database)
+            table (str): The name of the table to copy from
+            dest (str|None): The name of the table to copy to (which may be alias.table).
+                             By default, the table with the same name in the main database.
+                             If the destination is not one of the tables, it is added with the source's fields.
+            fields ([str]|None): The fields to copy. By default, the fields that both tables have.
+            clause (str/any): Optional clause to filter the rows being copied.
+
+        Returns:
+            int: The number of rows copied
+        """
+        src = f'{src_alias}.{table}'
+        dest = dest or table
+        src_fields = self.get_table_fields(src)
+        if '.' not in dest and dest not in self.tables:
+            self.tables[dest] = list(fields or src_fields)
+            self.update_database_structure()
+
+        if fields is None:
+            fields = [field for field in self.get_table_fields(dest) if field in src_fields]
+        field_s = ', '.join(fields)
+
+        params = ()
+        if not isinstance(clause, str):
+            clause, params = self.generate_clause(clause, table=src, parameterized=True)
+        cur = self.execute(f'INSERT INTO {dest} ({field_s}) SELECT {field_s} FROM {src} {clause}', params)
+        self.count_writes(cur.rowcount)
+        return cur.rowcount
 
     # Bonus "syntactic sugar" is provided in queries.py
     from ._queries import generate_select_query, select, select_one
     from ._queries import lookup_all, lookup, count, dict_lookup, unique_counts, sum_counts, insert, bulk_insert
-    from ._queries import format_value, generate_clause, sum, update, unique_insert, table_as_dict
-    from ._queries import delete, delete_duplicates
+    from ._queries import format_value, format_param, generate_clause, sum, update, unique_insert, table_as_dict
+    from ._queries import delete, delete_duplicates, bulk_update, bulk_unique_insert
+
+    # Fetching columns instead of rows is implemented in columnar.py
+    from ._columnar import select_columns
+
+    # Processing rows in parallel is implemented in parallel.py
+    from ._parallel import parallel_map
+
+    # Index management is implemented in indexes.py
+    from ._indexes import get_sql_indexes, update_indexes, infer_indexes
+
+    # Maintained row counts are implemented in counts.py
+    from ._counts import update_count_triggers, get_maintained_count, get_approximate_count
+
+    # Query plans are implemented in explain.py
+    from ._explain import get_query_plan, explain, enable_strict_mode, disable_strict_mode, check_full_scan
+
+    # Timing statistics for the statements are implemented in instrumentation.py
+    from ._instrumentation import enable_instrumentation, disable_instrumentation, stats
 
     # Bonus clean printing implemented in printable.py
     from ._printable import print_table
@@ -305,11 +857,59 @@ class SQLiteDB:
         for table in tables:
             db.execute(f'DROP TABLE IF EXISTS {table}')
 
+        self.invalidate_results()
+
+        # Clear the fingerprint so that the tables are recreated
+        db.execute('PRAGMA user_version=0')
         self.update_database_structure()
 
     def write(self):
         """Commit the changes to the file."""
-        self.raw_db.commit()
+        with self.write_lock():
+            self.raw_db.commit()
+
+    def transaction(self, commit_every=None, commit_interval=None):
+        """Create a context manager for running commands in a transaction.
+
+        Transactions can be nested, and an exception inside an inner transaction only rolls back that block.
+
+        Args:
+            commit_every (int|None): If specified, commit after this many rows have been written
+            commit_interval (float|None): If specified, commit after this many seconds of writing
+
+        Returns:
+            Transaction
+        """
+        return Transaction(self, commit_every, commit_interval)
+
+    def commit_batch(self):
+        """Commit the changes so far, while remaining inside any active transactions."""
+        with self.write_lock():
+            self.raw_db.commit()
+            for transaction in self.transactions:
+                self.raw_db.execute(f'SAVEPOINT {transaction.name}')
+        if self.transactions:
+            self.transactions[0].reset_counts()
+
+    def count_writes(self, n):
+        """Record that n rows were written, which may trigger a commit in an active transaction.
+
+        Args:
+            n (int): Number of rows written
+        """
+        if self.transactions:
+            self.transactions[0].count_writes(n)
+
+    def pool_stats(self):
+        """Return statistics about how the connection pool has been used, including time spent waiting.
+
+        Returns:
+            dict or None: The number of reader connections, reads, writes, and waits (with the total seconds waited)
+        """
+        if self.pool is None:
+            return None
+        with self.pool.lock:
+            return dict(self.pool.stats)
 
     def close(self, print_table_sizes=True):
         """Write data to database. Possibly print the number of rows in each table.
@@ -320,6 +920,9 @@ class SQLiteDB:
         if print_table_sizes:
             print(self)
         self.write()
+        if self.pool is not None:
+            # The writer is closed last, since read-only connections can't clean up the WAL files
+            self.pool.close()
         self.raw_db.close()
 
     def dispose(self):
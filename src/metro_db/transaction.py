@@ -0,0 +1,81 @@
+import time
+
+
+class Transaction:
+    """Context manager for a (possibly nested) transaction, implemented with SAVEPOINTs.
+
+    Created with SQLiteDB.transaction(). If the block raises an exception, the changes made within the block are
+    rolled back. Otherwise, the changes are kept and committed when the outermost transaction finishes.
+
+    The outermost transaction can also commit automatically after a number of rows have been written
+    (commit_every) and/or after some number of seconds (commit_interval), to bound the size of the journal.
+    Changes that have been committed this way cannot be rolled back afterward. While an inner transaction is open,
+    the commit is deferred until it finishes, so that the inner block can still be rolled back on its own.
+
+    If the database has a connection pool, the transaction holds the writer lock until it finishes.
+    """
+
+    def __init__(self, db, commit_every=None, commit_interval=None):
+        """
+        Args:
+            db (SQLiteDB): The database
+            commit_every (int|None): If specified, commit after this many rows have been written
+            commit_interval (float|None): If specified, commit after this many seconds of writing
+        """
+        self.db = db
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.name = None
+        self.writes = 0
+        self.last_commit = None
+        self.lock = None
+        # Whether a limit was reached while an inner transaction was open
+        self.commit_due = False
+
+    def __enter__(self):
+        self.lock = self.db.write_lock()
+        self.lock.__enter__()
+        self.name = f'metro_db_{len(self.db.transactions)}'
+        self.db.raw_db.execute(f'SAVEPOINT {self.name}')
+        self.db.transactions.append(self)
+        self.writes = 0
+        self.last_commit = time.monotonic()
+        self.commit_due = False
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.transactions.pop()
+        try:
+            if exc_type is not None:
+                self.db.raw_db.execute(f'ROLLBACK TO {self.name}')
+                # Results cached since the savepoint may include the changes that were rolled back
+                self.db.invalidate_results()
+            self.db.raw_db.execute(f'RELEASE {self.name}')
+            if exc_type is None and not self.db.transactions:
+                self.db.write()
+            elif len(self.db.transactions) == 1 and self.db.transactions[0].commit_due:
+                # The outermost transaction reached a limit while this block was open
+                self.db.commit_batch()
+        finally:
+            self.lock.__exit__(None, None, None)
+
+    def count_writes(self, n):
+        """Record that n rows were written, and commit if either of the limits has been reached.
+
+        Args:
+            n (int): Number of rows written
+        """
+        self.writes += n
+        if self.commit_every is not None and self.writes >= self.commit_every:
+            self.commit_due = True
+        elif self.commit_interval is not None and time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit_due = True
+
+        # Committing would also commit the changes of any inner transactions, which could then not be rolled back
+        if self.commit_due and len(self.db.transactions) == 1:
+            self.db.commit_batch()
+
+    def reset_counts(self):
+        self.writes = 0
+        self.last_commit = time.monotonic()
+        self.commit_due = False
@@ -1,4 +1,28 @@
+import collections
+import keyword
+import re
 import sqlite3
+import threading
+
+
+# Queries that only read from the database
+READ_QUERY = re.compile(r'\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+
+# Tables that are (probably) written to by a command
+WRITTEN_TABLES = re.compile(r'\b(?:INTO|UPDATE(?:\s+OR\s+\w+)?|FROM|TABLE(?:\s+IF(?:\s+NOT)?\s+EXISTS)?)\s+'
+                            r'((?:[\w"`\[\]]+\.)?[\w"`\[\]]+)', re.IGNORECASE)
+
+# Placeholder for values that are not in a cache (since None is a valid value)
+MISSING = object()
+
+
+def table_key(name):
+    """Normalize a table name (e.g. "Main".Movie) for comparing"""
+    name = re.sub(r'["`\[\]]', '', name).lower()
+    if name.startswith('main.'):
+        name = name[5:]
+    return name
 
 
 class DatabaseError(sqlite3.Error):
@@ -12,15 +36,30 @@ class DatabaseError(sqlite3.Error):
 
 
 class Row(sqlite3.Row):
+    """sqlite3.Row with a few more dictionary features.
+
+    The subclasses generated by make_row_class share a mapping from column names to positions (_index),
+    so that checking for and getting fields does not need to search the keys.
+    """
+    __slots__ = ()
+    _index = None
+
     def __contains__(self, field):
-        return field in self.keys()
+        if self._index is None:
+            return field in self.keys()
+        return field in self._index
 
     def get(self, field, default_value=None):
-        if field in self:
-            return self[field]
-        else:
+        if self._index is None:
+            if field in self.keys():
+                return self[field]
             return default_value
 
+        index = self._index.get(field)
+        if index is None:
+            return default_value
+        return self[index]
+
     def items(self):
         for field in self.keys():
             yield field, self[field]
@@ -29,44 +68,380 @@ class Row(sqlite3.Row):
         return str(dict(self))
 
 
+def make_row_class(columns):
+    """Generate a Row subclass with a precomputed index for the given columns
+
+    Args:
+        columns (tuple): The names of the columns (i.e. from the cursor's description)
+
+    Returns:
+        type: A subclass of Row
+    """
+    index = {}
+    for i, column in enumerate(columns):
+        # Like sqlite3.Row, the first column with the name wins
+        index.setdefault(column, i)
+    return type('Row', (Row,), {'__slots__': (), '_index': index})
+
+
+class Record:
+    """Base class for the generated record classes, which store the values of a row in __slots__ attributes.
+
+    Values can be accessed as attributes, or like Row, by index or column name.
+    """
+    __slots__ = ()
+    _fields = ()
+    _columns = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._index:
+                raise IndexError('No item with that key')
+            key = self._index[key]
+        elif isinstance(key, slice):
+            return tuple(getattr(self, field) for field in self._fields[key])
+        return getattr(self, self._fields[key])
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __contains__(self, column):
+        return column in self._index
+
+    def keys(self):
+        return list(self._columns)
+
+    def get(self, column, default_value=None):
+        if column in self._index:
+            return getattr(self, self._fields[self._index[column]])
+        else:
+            return default_value
+
+    def items(self):
+        for column, field in zip(self._columns, self._fields):
+            yield column, getattr(self, field)
+
+    def __repr__(self):
+        return str(dict(self.items()))
+
+
+def _attribute_names(columns):
+    """Convert column names into unique valid attribute names, replacing invalid ones with _{index}"""
+    names = []
+    for i, column in enumerate(columns):
+        if not column.isidentifier() or keyword.iskeyword(column) or column.startswith('_') or column in names:
+            column = f'_{i}'
+        names.append(column)
+    return names
+
+
+def make_record_class(columns, name='Record'):
+    """Generate a Record subclass with a __slots__ attribute for each of the columns.
+
+    Like sqlite3.Row, the class is constructed with a cursor and a tuple of values, so it can be used as a row_factory.
+
+    Args:
+        columns (str[]): Names of the columns
+        name (str): Name of the class
+
+    Returns:
+        class
+    """
+    fields = _attribute_names(columns)
+    if fields:
+        targets = ''.join(f'self.{field}, ' for field in fields)
+        source = f'def __init__(self, cursor, row):\n    {targets}= row\n'
+    else:
+        source = 'def __init__(self, cursor, row):\n    pass\n'
+    namespace = {}
+    # Generating the assignment (like namedtuple and dataclasses do) avoids looping over the fields for every row
+    exec(source, {}, namespace)
+
+    return type(name, (Record,), {
+        '__slots__': tuple(fields),
+        '__init__': namespace['__init__'],
+        '_fields': tuple(fields),
+        '_columns': tuple(columns),
+        '_index': {column: i for i, column in enumerate(columns)},
+    })
+
+
+def first_value(cursor, row):
+    """Row factory that just returns the value of the first column"""
+    return row[0]
+
+
+def make_namedtuple_class(columns, name='Record'):
+    """Generate a namedtuple class that (like sqlite3.Row) can be constructed with a cursor and a tuple of values.
+
+    Args:
+        columns (str[]): Names of the columns
+        name (str): Name of the class
+
+    Returns:
+        class
+    """
+    base = collections.namedtuple(name, columns, rename=True)
+    return type(name, (base,), {
+        '__slots__': (),
+        '__new__': lambda cls, cursor, row: tuple.__new__(cls, row),
+    })
+
+
 class FlexibleIterator:
-    def __init__(self, iterable):
+    """Iterator that can also be treated like a list, i.e. with len, square brackets and in.
+
+    The list form is only filled as far as needed, so results[0] only reads the first item.
+    """
+
+    def __init__(self, iterable, columns=None):
         self.iterable = iterable
+        # Names of the columns of the rows, if known
+        self.columns = columns
         self.list_form = None
         self.index = 0
+        self.exhausted = False
 
     def __iter__(self):
-        if self.list_form:
-            return self.list_form.__iter__()
+        if self.list_form is not None:
+            return self._iterate_list()
         return self
 
     def __next__(self):
-        if self.list_form:
-            if self.index < len(self.list_form):
-                value = self.list_form[self.index]
-                self.index += 1
-                return value
-            else:
-                raise StopIteration()
+        if self.list_form is None:
+            return next(self.iterable)
 
-        return next(self.iterable)
+        if self.index < len(self.list_form) or self._fill(self.index + 1):
+            value = self.list_form[self.index]
+        else:
+            value = next(self.iterable)
+        self.index += 1
+        return value
 
-    def __len__(self):
+    def _start_list(self):
         if self.list_form is None:
-            self.list_form = list(self.iterable)
-        return len(self.list_form) - self.index
+            self.list_form = []
+
+    def _fill(self, n=None):
+        """Add items from the iterable to the list form until it has at least n items (or all of them, if None)
+
+        Returns:
+            bool: Whether the list form has at least n items
+        """
+        while n is None or len(self.list_form) < n:
+            try:
+                self.list_form.append(next(self.iterable))
+            except StopIteration:
+                self.exhausted = True
+                return n is None
+        return True
+
+    def _iterate_list(self):
+        i = 0
+        while i < len(self.list_form) or self._fill(i + 1):
+            yield self.list_form[i]
+            i += 1
+
+    def _size(self):
+        """Return the total number of items in the list form"""
+        self._fill()
+        return len(self.list_form)
+
+    def __len__(self):
+        self._start_list()
+        return self._size() - self.index
 
     def __getitem__(self, index):
-        if self.list_form is None:
-            self.list_form = list(self.iterable)
+        self._start_list()
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step or 1
+            if start >= 0 and stop is not None and stop >= 0 and step > 0:
+                self._fill(stop)
+            else:
+                self._fill()
+        elif index >= 0:
+            self._fill(index + 1)
+        else:
+            self._fill()
         return self.list_form[index]
 
-    def __contains__(self, field):
-        if self.list_form is None:
-            self.list_form = list(self.iterable)
-        return field in self.list_form
+    def __contains__(self, item):
+        self._start_list()
+        if item in self.list_form:
+            return True
+        while self._fill(len(self.list_form) + 1):
+            if self.list_form[-1] == item:
+                return True
+        return False
 
     def __repr__(self):
-        if self.list_form is None:
-            self.list_form = list(self.iterable)
+        self._start_list()
+        self._fill()
         return str(self.list_form)
+
+
+class QueryIterator(FlexibleIterator):
+    """FlexibleIterator over the results of a SELECT query.
+
+    Rather than reading all of the results, len is answered with a COUNT query, and items that are not
+    cached are retrieved with LIMIT/OFFSET queries. If max_cached is specified, at most that many rows are cached.
+    """
+
+    def __init__(self, db, cursor, query, params=(), max_cached=None):
+        columns = [column[0] for column in cursor.description] if cursor.description else None
+        FlexibleIterator.__init__(self, cursor, columns)
+        self.db = db
+        self.query = query.strip().rstrip(';')
+        self.params = params or ()
+        self.max_cached = max_cached
+        self.pushdown = cursor.description is not None and READ_QUERY.match(self.query)
+
+        # Number of rows iterated over before switching to the list form
+        self.offset = 0
+        self.size = None
+
+    def __next__(self):
+        if self.list_form is None:
+            value = next(self.iterable)
+            self.offset += 1
+            return value
+        return FlexibleIterator.__next__(self)
+
+    def _fill(self, n=None):
+        if not self.pushdown or self.max_cached is None:
+            return FlexibleIterator._fill(self, n)
+        elif n is None:
+            FlexibleIterator._fill(self, self.max_cached)
+            return False
+        return FlexibleIterator._fill(self, min(n, self.max_cached)) and len(self.list_form) >= n
+
+    def _fetch(self, start, limit=-1):
+        """Run the query for (up to) limit rows starting at start (relative to the list form)"""
+        if isinstance(self.params, dict):
+            query = f'SELECT * FROM ({self.query}) LIMIT :metro_db_limit OFFSET :metro_db_offset'
+            params = dict(self.params, metro_db_limit=limit, metro_db_offset=self.offset + start)
+        else:
+            query = f'SELECT * FROM ({self.query}) LIMIT ? OFFSET ?'
+            params = tuple(self.params) + (limit, self.offset + start)
+
+        try:
+            cursor = self.db.raw_db.execute(query, params)
+        except sqlite3.Error as e:
+            raise DatabaseError(str(e), query, params) from None
+        cursor.row_factory = self.iterable.row_factory
+        return cursor
+
+    def _rows(self, start, stop):
+        if self._fill(stop) or self.exhausted:
+            return self.list_form[start:stop]
+        cached = self.list_form[start:stop]
+        start = max(start, len(self.list_form))
+        return cached + list(self._fetch(start, stop - start))
+
+    def _iterate_list(self):
+        yield from FlexibleIterator._iterate_list(self)
+        if not self.exhausted:
+            yield from self._fetch(len(self.list_form))
+
+    def _size(self):
+        if not self.pushdown or self.exhausted:
+            return FlexibleIterator._size(self)
+        if self.size is None:
+            query = f'SELECT COUNT(*) FROM ({self.query})'
+            try:
+                self.size = self.db.raw_db.execute(query, self.params).fetchone()[0] - self.offset
+            except sqlite3.Error as e:
+                raise DatabaseError(str(e), query, self.params) from None
+        return self.size
+
+    def __getitem__(self, index):
+        if not self.pushdown:
+            return FlexibleIterator.__getitem__(self, index)
+
+        self._start_list()
+        if isinstance(index, slice):
+            start, stop, step = index.start or 0, index.stop, index.step or 1
+            if start >= 0 and stop is not None and stop >= 0 and step > 0:
+                indexes = range(start, stop, step)
+            else:
+                indexes = range(*index.indices(self._size()))
+            if not indexes:
+                return []
+            first = min(indexes)
+            rows = self._rows(first, max(indexes) + 1)
+            return [rows[i - first] for i in indexes if i - first < len(rows)]
+
+        if index < 0:
+            index += self._size()
+        rows = self._rows(index, index + 1) if index >= 0 else []
+        if not rows:
+            raise IndexError('FlexibleIterator index out of range')
+        return rows[0]
+
+    def __contains__(self, item):
+        if FlexibleIterator.__contains__(self, item):
+            return True
+        elif self.exhausted or not self.pushdown:
+            return False
+        return any(row == item for row in self._fetch(len(self.list_form)))
+
+    def __repr__(self):
+        if not self.pushdown:
+            return FlexibleIterator.__repr__(self)
+        return str(self[:])
+
+
+class LRUCache:
+    """Dictionary-like cache that holds at most maxsize entries, evicting the least recently used
+
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default_value=None):
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return self.data[key]
+            self.misses += 1
+            return default_value
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard(self, predicate):
+        """Remove the entries where predicate(key) is true"""
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __repr__(self):
+        return f'LRUCache({len(self.data)}/{self.maxsize}, hits={self.hits}, misses={self.misses})'
@@ -0,0 +1,112 @@
+import asyncio
+import pathlib
+import pytest
+from metro_db import AsyncSQLiteDB, AsyncMetroDB, DatabaseError
+
+TEST_FOLDER = pathlib.Path('tests')
+
+
+async def create_db():
+    db = AsyncSQLiteDB(pathlib.Path('async.db'), default_type='int', chunk_size=10)
+
+    def configure(db):
+        db.tables['scores'] = ['id', 'name', 'score']
+        db.field_types['name'] = 'str'
+        db.update_database_structure()
+
+    await db.run(configure)
+    return db
+
+
+def test_async_queries():
+    async def main():
+        db = await create_db()
+        assert await db.insert('scores', {'name': 'A', 'score': 5}) == 1
+        await db.bulk_insert('scores', ['name', 'score'], [(f'P{i}', i) for i in range(25)])
+        assert await db.count('scores') == 26
+        assert await db.lookup('score', 'scores', {'name': 'A'}) == 5
+        assert (await db.select_one('scores', clause=1))['name'] == 'A'
+        await db.update('scores', {'id': 1, 'score': 7})
+        assert await db.dict_lookup('name', 'score', 'scores', {'id': 1}) == {'A': 7}
+
+        # Streaming results (in chunks of 10)
+        names = [row['name'] async for row in db.select('scores', 'name', order='id')]
+        assert len(names) == 26
+        assert names[:2] == ['A', 'P0']
+
+        # Or all at once
+        scores = await db.lookup_all('score', 'scores', 'WHERE score < 3')
+        assert sorted(scores) == [0, 1, 2]
+
+        # Stopping early releases the cursor
+        results = db.query('SELECT * FROM scores')
+        async for row in results:
+            break
+        await results.aclose()
+        assert await db.run(lambda sync_db: len(db.iterators)) == 0
+
+        with pytest.raises(DatabaseError):
+            await db.query_one('SELECT * FROM missing')
+
+        await db.dispose()
+
+    asyncio.run(main())
+
+
+def test_group_commit():
+    async def main():
+        db = await create_db()
+        await db.run(lambda db: db.execute('DELETE FROM scores'))
+        commits = []
+
+        def count_commits(db):
+            original_write = db.write
+
+            def write():
+                commits.append(True)
+                original_write()
+            db.write = write
+        await db.run(count_commits)
+        commits.clear()
+
+        # Writes from many coroutines are committed together
+        await asyncio.gather(*[db.insert('scores', {'name': str(i), 'score': i}) for i in range(50)])
+        assert await db.count('scores') == 50
+        assert len(commits) < 50
+
+        # Reads see the changes, and failed writes don't affect the others
+        results = await asyncio.gather(db.insert('scores', {'name': 'x', 'score': 1}),
+                                       db.execute('INSERT INTO missing VALUES(1)'),
+                                       return_exceptions=True)
+        assert results[0] == 51
+        assert isinstance(results[1], DatabaseError)
+
+        # The changes made by a failed write are rolled back, even when they share a transaction with others
+        def insert_and_fail(db, name):
+            db.insert('scores', {'name': name, 'score': -1})
+            raise RuntimeError('Failed after inserting')
+
+        results = await asyncio.gather(db.insert('scores', {'name': 'y', 'score': 2}),
+                                       db.run(insert_and_fail, 'z'),
+                                       db.insert('scores', {'name': 'w', 'score': 3}),
+                                       return_exceptions=True)
+        assert isinstance(results[1], RuntimeError)
+        with pytest.raises(RuntimeError):
+            await db.run(insert_and_fail, 'v')
+        await db.write()
+        assert await db.count('scores') == 53
+        assert await db.lookup('name', 'scores', {'score': -1}) is None
+        await db.dispose()
+
+    asyncio.run(main())
+
+
+def test_async_metro():
+    async def main():
+        async with AsyncMetroDB('metro', folder=TEST_FOLDER) as db:
+            assert await db.run(lambda db: list(db.tables)) == ['characters']
+            await db.insert('characters', {'name': 'Kermit'})
+            assert await db.count('characters') == 1
+        (TEST_FOLDER / 'metro.db').unlink()
+
+    asyncio.run(main())
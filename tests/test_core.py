@@ -1,6 +1,10 @@
 import pathlib
 import pytest
+import sqlite3
+import threading
+import metro_db.sqlite_db
 from metro_db import SQLiteDB, DatabaseError
+from metro_db.sqlite_db import ROW_CLASS_CACHE_SIZE
 from enum import IntEnum
 
 
@@ -69,6 +73,41 @@ def test_insertion(basic_db):
     assert str(basic_db) == 'people(1)\n'
 
 
+def test_row_index(basic_db):
+    basic_db.update_database_structure()
+    basic_db.execute('INSERT INTO people (name, age, grade, present) VALUES(?, ?, ?, ?)', [1, 1, 1, 1])
+
+    # Rows with the same columns share a class (and its index)
+    row = basic_db.query_one('SELECT name, age FROM people')
+    assert row._index == {'name': 0, 'age': 1}
+    assert type(row) is type(basic_db.query_one('SELECT name, age FROM people'))
+    assert type(row) is not type(basic_db.query_one('SELECT name FROM people'))
+    assert not hasattr(row, '__dict__')
+
+    # Still compatible with sqlite3.Row
+    assert isinstance(row, sqlite3.Row)
+    assert row['NAME'] == '1'
+    assert row.keys() == ['name', 'age']
+    assert row == basic_db.query_one('SELECT name, age FROM people')
+
+    # The first of duplicate columns is used, like sqlite3.Row
+    row = basic_db.query_one('SELECT name, age AS name FROM people')
+    assert row.get('name') == row['name'] == '1'
+
+    # The generated classes are bounded
+    for i in range(ROW_CLASS_CACHE_SIZE + 100):
+        assert basic_db.query_one(f'SELECT {i} + 1')[0] == i + 1
+    assert len(basic_db.row_classes) == ROW_CLASS_CACHE_SIZE
+
+    # Rows without an index fall back to the keys
+    cursor = basic_db.raw_db.execute('SELECT name, grade FROM people')
+    row = cursor.fetchone()
+    assert row._index is None
+    assert row.get('grade') == 1
+    assert 'grade' in row
+    assert 'age' not in row
+
+
 def test_insertion_problem(basic_db):
     basic_db.update_database_structure()
     command = 'INSERT INTO people (name, age, grade, present) VALUES(?, ?, ?)'  # Missing ?
@@ -159,6 +198,18 @@ def test_inference(basic_db):
     db.close(print_table_sizes=False)
 
 
+def test_sql_schema(basic_db):
+    basic_db.tables['cars'] = ['make', 'model']
+    basic_db.tables['animals'] = ['name', 'legs']
+    basic_db.field_types['legs'] = 'int'
+    basic_db.update_database_structure()
+
+    schema = basic_db.get_sql_schema()
+    assert list(schema) == ['people', 'cars', 'animals']
+    assert schema['people'] == {'name': 'TEXT', 'age': 'INTEGER', 'grade': 'REAL', 'present': 'bool'}
+    assert schema['animals'] == basic_db.get_sql_table_types('animals')
+
+
 def test_column_add(basic_db):
     basic_db.update_database_structure()
     basic_db.execute('INSERT INTO people (name, age, grade, present) VALUES(?, ?, ?, ?)', [1, 1, 1, 1])
@@ -325,3 +376,369 @@ def test_no_create(basic_db):
         SQLiteDB(path, uri_query='mode=rw')
     assert 'unable to open database file' in str(e_info.value)
     assert not path.exists()
+
+
+def test_transactions(basic_db):
+    basic_db.update_database_structure()
+    basic_db.write()
+    other_db = SQLiteDB(pathlib.Path('basic.db'))
+
+    with basic_db.transaction():
+        basic_db.insert('people', {'name': 'David'})
+        with pytest.raises(RuntimeError):
+            with basic_db.transaction():
+                basic_db.insert('people', {'name': 'Elise'})
+                assert basic_db.count('people') == 2
+                raise RuntimeError()
+        with basic_db.transaction():
+            basic_db.insert('people', {'name': 'Fred'})
+
+        # Nothing committed yet
+        assert basic_db.count('people') == 2
+        assert other_db.count('people') == 0
+
+    assert list(basic_db.lookup_all('name', 'people')) == ['David', 'Fred']
+    assert other_db.count('people') == 2
+
+    with pytest.raises(RuntimeError):
+        with basic_db.transaction():
+            basic_db.delete('people', {'name': 'David'})
+            raise RuntimeError()
+    assert basic_db.count('people') == 2
+
+    other_db.close(print_table_sizes=False)
+
+
+def test_batched_commits(basic_db):
+    basic_db.update_database_structure()
+    basic_db.write()
+    other_db = SQLiteDB(pathlib.Path('basic.db'))
+
+    with basic_db.transaction(commit_every=3):
+        basic_db.insert('people', {'name': 'David'})
+        basic_db.insert('people', {'name': 'Elise'})
+        assert other_db.count('people') == 0
+        basic_db.bulk_insert('people', ['name'], [('Fred',), ('Gina',)])
+        assert other_db.count('people') == 4
+
+        # Inner transactions only roll back what has not been committed
+        with pytest.raises(RuntimeError):
+            with basic_db.transaction():
+                basic_db.insert('people', {'name': 'Hank'})
+                basic_db.update('people', {'name': 'Hank', 'age': 10}, 'name')
+                assert other_db.count('people') == 4
+                raise RuntimeError()
+        assert basic_db.count('people') == 4
+
+        # Rolled back writes still count toward the batch
+        basic_db.insert('people', {'name': 'Iris'})
+        assert other_db.count('people') == 5
+        basic_db.insert('people', {'name': 'Jack'})
+        assert other_db.count('people') == 5
+
+    assert other_db.count('people') == 6
+
+    with basic_db.transaction(commit_interval=0):
+        basic_db.delete('people', {'name': 'Jack'})
+        assert other_db.count('people') == 5
+
+    # Reaching the limit inside an inner transaction waits for it to finish, so it can still be rolled back
+    with basic_db.transaction(commit_every=3):
+        basic_db.insert('people', {'name': 'Kim'})
+        with pytest.raises(RuntimeError):
+            with basic_db.transaction():
+                for i in range(4):
+                    basic_db.insert('people', {'name': 'Inner', 'age': i})
+                assert other_db.count('people') == 5
+                raise RuntimeError()
+        assert other_db.count('people') == 6
+        assert basic_db.count('people', {'name': 'Inner'}) == 0
+
+        with basic_db.transaction():
+            basic_db.bulk_insert('people', ['name'], [('Lee',), ('Max',), ('Ned',)])
+            assert other_db.count('people') == 6
+        assert other_db.count('people') == 9
+
+    other_db.close(print_table_sizes=False)
+
+
+def test_indexes(basic_db):
+    basic_db.indexes['people'] = [
+        'name',
+        ['age', 'grade'],
+        {'fields': 'lower(name)', 'unique': True, 'where': 'present', 'name': 'unique_present_names'},
+    ]
+    basic_db.update_database_structure()
+    basic_db.execute('CREATE INDEX extra ON people(grade)')
+
+    def get_index_sql():
+        return basic_db.dict_lookup('name', 'sql', 'sqlite_master', {'type': 'index'})
+
+    assert get_index_sql() == {
+        'people_name_idx': 'CREATE INDEX people_name_idx ON people(name)',
+        'people_age_grade_idx': 'CREATE INDEX people_age_grade_idx ON people(age, grade)',
+        'unique_present_names': 'CREATE UNIQUE INDEX unique_present_names ON people(lower(name)) WHERE present',
+        'extra': 'CREATE INDEX extra ON people(grade)',
+    }
+
+    basic_db.insert('people', {'name': 'David', 'present': True})
+    basic_db.insert('people', {'name': 'david', 'present': False})
+    with pytest.raises(DatabaseError):
+        basic_db.insert('people', {'name': 'DAVID', 'present': True})
+
+    # Read them back
+    db = SQLiteDB(pathlib.Path('basic.db'))
+    db.infer_database_structure()
+    assert db.indexes['people'][2] == {'name': 'unique_present_names', 'fields': ['lower(name)'], 'unique': True,
+                                       'where': 'present'}
+    assert len(db.indexes['people']) == 4
+    db.close(print_table_sizes=False)
+
+    # Change, remove and keep some
+    basic_db.indexes['people'] = [
+        'name',
+        {'fields': ['lower(name)', 'age'], 'name': 'unique_present_names'},
+    ]
+    basic_db.update_database_structure()
+    assert get_index_sql() == {
+        'people_name_idx': 'CREATE INDEX people_name_idx ON people(name)',
+        'unique_present_names': 'CREATE INDEX unique_present_names ON people(lower(name), age)',
+    }
+    basic_db.insert('people', {'name': 'DAVID', 'present': True})
+
+
+def test_schema_fingerprint(basic_db):
+    basic_db.update_database_structure()
+    fingerprint = basic_db.get_pragma('user_version')
+    assert fingerprint == basic_db.get_schema_fingerprint()
+
+    # Same structure, so the database is not checked again
+    db = SQLiteDB(pathlib.Path('basic.db'))
+    db.tables['people'] = ['name', 'age', 'grade', 'present']
+    db.field_types = dict(basic_db.field_types)
+    assert db.get_schema_fingerprint() == fingerprint
+    db.execute('ALTER TABLE people ADD COLUMN email TEXT')
+    db.update_database_structure()
+    assert 'email' in db.get_sql_table_types('people')
+
+    # Changing the structure does a full check
+    db.field_types['grade'] = 'int'
+    db.update_database_structure()
+    assert db.get_sql_table_types('people') == {'name': 'TEXT', 'age': 'INTEGER', 'grade': 'INTEGER',
+                                                'present': 'bool'}
+    assert db.get_pragma('user_version') == db.get_schema_fingerprint() != fingerprint
+    db.close(print_table_sizes=False)
+
+
+def test_in_place_alter(basic_db):
+    basic_db.update_database_structure()
+    basic_db.execute('INSERT INTO people (name, age, grade, present) VALUES(?, ?, ?, ?)', ['David', 25, 98.6, True])
+    # Unmanaged indexes are lost if the table is copied
+    basic_db.execute('CREATE INDEX people_name ON people(name)')
+
+    basic_db.field_types['temperature'] = 'float'
+    basic_db.update_table('people', ['name', 'age', 'temperature'], {'temperature': 'grade'})
+    assert basic_db.get_sql_table_types('people') == {'name': 'TEXT', 'age': 'INTEGER', 'temperature': 'REAL'}
+    assert basic_db.lookup('temperature', 'people', {'name': 'David'}) == 98.6
+    assert 'people_name' in basic_db.get_sql_indexes()
+
+    # Dropping an indexed column falls back to copying the table
+    basic_db.update_table('people', ['age', 'temperature'])
+    assert basic_db.get_sql_table_types('people') == {'age': 'INTEGER', 'temperature': 'REAL'}
+    assert basic_db.lookup('temperature', 'people', {'age': 25}) == 98.6
+    assert not basic_db.get_sql_indexes()
+
+
+def test_alter_without_column_support(basic_db, monkeypatch):
+    monkeypatch.setattr(metro_db.sqlite_db, 'CAN_RENAME_COLUMN', False)
+    monkeypatch.setattr(metro_db.sqlite_db, 'CAN_DROP_COLUMN', False)
+
+    basic_db.update_database_structure()
+    basic_db.execute('INSERT INTO people (name, age, grade, present) VALUES(?, ?, ?, ?)', ['David', 25, 98.6, True])
+    basic_db.execute('CREATE INDEX people_name ON people(name)')
+
+    basic_db.update_table('people', ['name', 'age', 'present'])
+    assert basic_db.get_sql_table_types('people') == {'name': 'TEXT', 'age': 'INTEGER', 'present': 'bool'}
+    assert not basic_db.get_sql_indexes()
+
+    basic_db.update_table('people', ['name', 'years', 'present'], {'years': 'age'})
+    assert basic_db.lookup('years', 'people', {'name': 'David'}) == '25'
+
+
+def test_chunked_restructure(basic_db):
+    basic_db.update_database_structure()
+    basic_db.bulk_insert('people', ['name', 'age', 'grade', 'present'],
+                         [(f'Student {i}', i, i * 1.5, i % 2 == 0) for i in range(10)])
+    basic_db.delete('people', {'age': 4})
+
+    basic_db.field_types['grade'] = 'int'
+    updates = []
+
+    def interrupt(table, copied, total):
+        updates.append((table, copied, total))
+        if copied == 6:
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        basic_db.update_database_structure(chunk_size=3, progress=interrupt)
+    assert updates == [('people', 3, 9), ('people', 6, 9)]
+
+    # The old table is untouched
+    assert basic_db.get_sql_table_types('people')['grade'] == 'REAL'
+    assert basic_db.count('people') == 9
+
+    updates = []
+    basic_db.update_database_structure(chunk_size=3, progress=lambda *args: updates.append(args))
+    assert updates == [('people', 9, 9)]
+    assert basic_db.get_sql_table_types('people')['grade'] == 'INTEGER'
+    assert list(basic_db.lookup_all('age', 'people')) == [0, 1, 2, 3, 5, 6, 7, 8, 9]
+    assert isinstance(basic_db.lookup('grade', 'people', {'name': 'Student 8'}), int)
+    assert basic_db.count('_metro_checkpoints') == 0
+
+    db = SQLiteDB(pathlib.Path('basic.db'))
+    db.infer_database_structure()
+    assert list(db.tables) == ['people']
+    db.close(print_table_sizes=False)
+
+
+def test_pool():
+    db = SQLiteDB(pathlib.Path('pooled.db'), default_type='int', pool_size=2)
+    db.tables['counts'] = ['id', 'thread', 'value']
+    db.update_database_structure()
+    assert db.get_pragma('journal_mode') == 'wal'
+
+    # Uncommitted changes are visible to queries
+    db.insert('counts', {'thread': -1, 'value': 0})
+    assert db.count('counts') == 1
+    db.write()
+
+    def work(thread):
+        for value in range(20):
+            db.insert('counts', {'thread': thread, 'value': value})
+            db.write()
+            assert db.count('counts', {'thread': thread}) == value + 1
+            assert db.lookup('MAX(value)', 'counts', {'thread': thread}) == value
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert db.count('counts') == 81
+    assert len(db.select('counts', clause={'thread': 3})) == 20
+
+    stats = db.pool_stats()
+    assert 1 <= stats['readers'] <= 2
+    assert stats['reads'] > 0
+    assert stats['writes'] > 0
+    db.dispose()
+
+    # Connection-level pragmas are also set on the readers, including ones that are already open
+    db = SQLiteDB(pathlib.Path('pooled.db'), pool_size=1, pragmas={'profile': 'read_heavy', 'cache_size': -1234})
+    db.tables['counts'] = ['id', 'value']
+    db.update_database_structure()
+    db.write()
+    with db.pool.reader() as connection:
+        assert connection.execute('PRAGMA cache_size').fetchone()[0] == -1234
+        assert connection.execute('PRAGMA mmap_size').fetchone()[0] == 268435456
+    db.set_pragmas({'cache_size': -4321})
+    with db.pool.reader() as connection:
+        assert connection.execute('PRAGMA cache_size').fetchone()[0] == -4321
+    db.dispose()
+
+    with pytest.raises(DatabaseError):
+        SQLiteDB(':memory:', pool_size=2)
+
+
+def test_attach():
+    day1 = SQLiteDB(pathlib.Path('day1.db'), default_type='int')
+    day1.tables['visits'] = ['id', 'page', 'hits', 'seconds']
+    day1.field_types['page'] = 'str'
+    day1.field_types['seconds'] = 'float'
+    day1.update_database_structure()
+    day1.bulk_insert('visits', ['page', 'hits', 'seconds'], [('home', 10, 1.5), ('about', 2, 3.0), ('blog', 7, 9.5)])
+    day1.write()
+
+    db = SQLiteDB(pathlib.Path('summary.db'))
+    db.tables['visits'] = ['id', 'page', 'hits', 'day']
+    db.field_types['id'] = 'int'
+    db.field_types['hits'] = 'int'
+    db.update_database_structure()
+
+    db.attach(day1, 'day1')
+    assert db.attached_tables == {'day1.visits': ['id', 'page', 'hits', 'seconds']}
+    assert db.get_field_type('seconds') == 'REAL'
+    assert db.sum('day1.visits', 'seconds') == 14.0
+    assert db.count('day1.visits') == 3
+    assert db.lookup('hits', 'day1.visits', {'page': 'blog'}) == 7
+    assert db.select_one('day1.visits', clause=2)['page'] == 'about'
+    assert list(db.table_as_dict('day1.visits', 'page')) == ['home', 'about', 'blog']
+
+    # Copy the common fields
+    assert db.copy_table('day1', 'visits', clause='WHERE hits > 5') == 2
+    assert list(db.lookup_all('page', 'visits')) == ['home', 'blog']
+
+    # Copy into a new table
+    assert db.copy_table('day1', 'visits', 'popular', ['page', 'hits'], {'page': 'home'}) == 1
+    assert db.tables['popular'] == ['page', 'hits']
+    assert db.lookup('hits', 'popular') == 10
+
+    # Attached tables are kept after structure updates
+    db.update_database_structure()
+    assert db.primary_key_per_table['day1.visits'] == 'id'
+
+    db.detach('day1')
+    assert db.attached_tables == {}
+    with pytest.raises(DatabaseError):
+        db.count('day1.visits')
+    with pytest.raises(DatabaseError):
+        db.attach(day1, 'main')
+
+    db.dispose()
+    day1.dispose()
+
+
+def test_maintained_counts(basic_db):
+    basic_db.update_database_structure()
+    basic_db.insert('people', {'name': 'Lisa', 'age': 8})
+    basic_db.write()
+
+    # Existing rows are counted when the triggers are created
+    basic_db.maintain_counts = True
+    basic_db.update_database_structure()
+    assert basic_db.get_maintained_count('people') == 1
+
+    basic_db.bulk_insert('people', ['name', 'age'], [('Bart', 10), ('Maggie', 1), ('Marge', 36)])
+    assert basic_db.count('people') == 4
+    basic_db.delete('people', {'name': 'Marge'})
+    assert basic_db.count('people') == 3
+    assert basic_db.count('people', 'WHERE age < 5') == 1
+
+    # Replaced rows are subtracted
+    bart = basic_db.lookup('rowid', 'people', {'name': 'Bart'})
+    basic_db.execute('INSERT OR REPLACE INTO people (rowid, name, age) VALUES(?, ?, ?)', (bart, 'Bart', 11))
+    basic_db.execute('REPLACE INTO people (rowid, name, age) VALUES(?, ?, ?)', (bart, 'Bart', 12))
+    assert basic_db.count('people') == 3
+    assert basic_db.lookup('COUNT(*)', 'people') == 3
+
+    # Changes that are rolled back are not counted
+    with pytest.raises(RuntimeError):
+        with basic_db.transaction():
+            basic_db.insert('people', {'name': 'Homer', 'age': 38})
+            raise RuntimeError('D\'oh')
+    assert basic_db.count('people') == 3
+
+    # Restructuring the table recreates the triggers
+    basic_db.tables['people'].append('school')
+    basic_db.tables['people'].remove('present')
+    basic_db.update_database_structure()
+    basic_db.insert('people', {'name': 'Milhouse', 'age': 10})
+    assert basic_db.get_maintained_count('people') == 4
+    assert basic_db.count('people') == basic_db.lookup('COUNT(*)', 'people')
+
+    basic_db.maintain_counts = False
+    basic_db.update_database_structure()
+    assert basic_db.get_maintained_count('people') is None
+    assert not basic_db.query_one("SELECT name FROM sqlite_master WHERE name LIKE '_metro%'")
+    assert basic_db.count('people', approximate=True) == 4
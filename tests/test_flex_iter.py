@@ -1,6 +1,8 @@
 
+from metro_db import SQLiteDB
 from metro_db.types import FlexibleIterator
 
+import pathlib
 import pytest
 
 
@@ -69,3 +71,75 @@ def test_multiple(flex_range):
         assert flex_range[0] == 1
         c += 1
     assert c == 5
+
+
+def test_partial_list(flex_range):
+    assert flex_range[1] == 2
+    assert flex_range.list_form == [1, 2]
+    assert flex_range[:3] == [1, 2, 3]
+    assert 4 in flex_range
+    assert flex_range.list_form == [1, 2, 3, 4]
+    assert list(flex_range) == [1, 2, 3, 4, 5]
+
+
+@pytest.fixture()
+def number_db():
+    db = SQLiteDB(pathlib.Path('numbers.db'), default_type='int')
+    db.tables['numbers'] = ['id', 'value']
+    db.update_database_structure()
+    db.bulk_insert('numbers', ['value'], [(v,) for v in range(1, 101)])
+    yield db
+    db.dispose()
+
+
+def test_query_pushdown(number_db):
+    values = number_db.lookup_all('value', 'numbers')
+    assert len(values) == 100
+    assert values.list_form == []  # Counted without reading the rows
+
+    assert values[2] == 3
+    assert len(values.list_form) == 3  # Only read as far as needed
+    assert values[-1] == 100
+    assert values[10:13] == [11, 12, 13]
+    assert values[-3:] == [98, 99, 100]
+    assert values[::-40] == [100, 60, 20]
+    assert 50 in values
+    assert 500 not in values
+    with pytest.raises(IndexError):
+        values[100]
+
+    # Iterating still covers all the rows
+    assert next(values) == 1
+    assert len(values) == 99
+    assert sum(values) == sum(range(1, 101))
+
+
+def test_query_offset(number_db):
+    results = number_db.query('SELECT value FROM numbers WHERE value > ?', (90,))
+    assert next(results)['value'] == 91
+    assert next(results)['value'] == 92
+    # Once treated like a list, the rows start with the first one not yet iterated over
+    assert len(results) == 8
+    assert results[0]['value'] == 93
+    assert results[-1]['value'] == 100
+    assert str(results) == str([{'value': v} for v in range(93, 101)])
+
+
+def test_max_cached(number_db):
+    number_db.max_cached_rows = 10
+    values = number_db.lookup_all('value', 'numbers')
+    assert values[50] == 51
+    assert values[5:15] == list(range(6, 16))
+    assert len(values.list_form) == 10
+    assert 75 in values
+    assert len(values.list_form) == 10
+    assert list(values) == list(range(1, 101))
+    assert [next(values) for i in range(20)] == list(range(1, 21))
+    assert len(values) == 80
+    assert len(values.list_form) == 10
+
+
+def test_non_select(number_db):
+    results = number_db.query('PRAGMA table_info(numbers)')
+    assert len(results) == 2
+    assert results[1]['name'] == 'value'
@@ -1,6 +1,6 @@
 import pathlib
 import pytest
-from metro_db import MetroDB
+from metro_db import MetroDB, ShardedMetroDB, DatabaseError
 from enum import IntEnum
 
 
@@ -49,3 +49,103 @@ def test_scope():
         assert 'characters' in db.tables
 
     pathlib.Path('tests/metro.db').unlink()
+
+
+def test_pragmas():
+    with MetroDB('tuned', folder=TEST_FOLDER) as db:
+        assert db.get_pragma('journal_mode') == 'wal'
+        assert db.get_pragma('synchronous') == 2
+        assert db.get_pragma('mmap_size') == 268435456
+
+        db.insert('characters', {'name': 'Gwen', 'line_count': 3})
+        previous = db.set_pragmas('bulk_load')
+        assert db.get_pragma('synchronous') == 0
+        assert db.count('characters') == 1
+        db.set_pragmas(previous)
+        assert db.get_pragma('synchronous') == 2
+
+        with pytest.raises(DatabaseError):
+            db.set_pragmas('turbo')
+
+    pathlib.Path('tests/tuned.db').unlink()
+
+
+def test_yaml_indexes():
+    with MetroDB('tuned', folder=TEST_FOLDER) as db:
+        assert set(db.get_sql_indexes()) == {'characters_name_idx', 'characters_line_count_idx'}
+
+        # Cached results
+        assert db.result_cache.maxsize == 100
+        assert db.result_cache_tables == {'characters'}
+        assert db.count('characters') == 0
+        assert db.count('characters') == 0
+        assert db.result_cache.hits == 1
+
+    pathlib.Path('tests/tuned.db').unlink()
+
+
+def test_sharded():
+    db = ShardedMetroDB('metro', {'characters': 'name'}, 3, folder=TEST_FOLDER, enums_to_register=[Role])
+    db.update_database_structure()
+    names = ['Kermit', 'Piggy', 'Fozzie', 'Gonzo', 'Rowlf', 'Scooter', 'Animal']
+    db.bulk_insert('characters', ['name', 'role', 'line_count'],
+                   [(name, Role.PROTAGONIST, 10 * i) for i, name in enumerate(names)])
+    db.insert('characters', {'name': 'Kermit', 'role': Role.LOVE_INTEREST, 'line_count': 5})
+
+    # Rows are spread across the shards, with each name in one shard
+    counts = [shard.count('characters') for shard in db.shards]
+    assert sum(counts) == 8
+    assert max(counts) < 8
+    assert db.get_shard('characters', 'Kermit').count('characters', {'name': 'Kermit'}) == 2
+
+    assert db.count('characters') == 8
+    assert db.count('characters', {'name': 'Kermit'}) == 2
+    assert db.sum('characters', 'line_count') == 215
+    assert db.lookup('line_count', 'characters', {'name': 'Animal'}) == 60
+    assert db.unique_counts('characters', 'name')['Kermit'] == 2
+    assert db.sum_counts('characters', 'line_count', 'role') == {Role.PROTAGONIST: 210, Role.LOVE_INTEREST: 5}
+    assert sorted(db.lookup_all('name', 'characters', distinct=True)) == sorted(names)
+
+    # Ordered results are merged
+    rows = db.select('characters', ['name', 'line_count'], order=['-line_count', 'name'])
+    assert [row['line_count'] for row in rows] == [60, 50, 40, 30, 20, 10, 5, 0]
+    rows = db.select('characters', ['name'], 'WHERE line_count > 25', order='name DESC')
+    assert [row['name'] for row in rows] == ['Scooter', 'Rowlf', 'Gonzo', 'Animal']
+
+    with pytest.raises(DatabaseError):
+        db.select('characters', ['role', 'COUNT(*)'], grouping='role')
+    with pytest.raises(DatabaseError):
+        db.select('characters', order='LENGTH(name)')
+    with pytest.raises(DatabaseError):
+        db.insert('characters', {'line_count': 3})
+    with pytest.raises(DatabaseError):
+        db.lookup('MAX(line_count)', 'characters')
+    assert db.lookup('MAX(line_count)', 'characters', {'name': 'Kermit'}) == 5
+
+    # Generated ids are only unique within each shard, so rows are never merged by them
+    rows = db.table_as_dict('characters', 'name', ['name', 'line_count'], 'WHERE line_count > 0')
+    assert len(rows) == 7
+    assert rows['Kermit']['line_count'] == 5
+    assert len(db.table_as_dict('characters', 'line_count')) == 8
+    with pytest.raises(DatabaseError):
+        db.table_as_dict('characters')
+    with pytest.raises(DatabaseError):
+        db.dict_lookup('id', 'name', 'characters')
+    with pytest.raises(DatabaseError):
+        db.lookup('name', 'characters', 1)
+
+    db.update('characters', {'name': 'Animal', 'line_count': 61}, 'name')
+    assert db.lookup('line_count', 'characters', {'name': 'Animal'}) == 61
+    db.delete('characters', {'name': 'Kermit'})
+    assert db.count('characters') == 6
+    db.dispose()
+
+
+def test_sharded_yaml_path():
+    db = ShardedMetroDB('sharded', {'characters': 'name'}, 2, folder=TEST_FOLDER, enums_to_register=[Role])
+    db.load_yaml(TEST_FOLDER / 'metro.yaml')
+    db.update_database_structure()
+    assert 'characters' in db.tables
+    db.insert('characters', {'name': 'Beaker', 'role': Role.PROTAGONIST, 'line_count': 1})
+    assert db.count('characters') == 1
+    db.dispose()
@@ -1,7 +1,11 @@
+import array
 import datetime
+import math
+import operator
 import pathlib
 import pytest
 from metro_db import SQLiteDB, DatabaseError
+from metro_db.types import LRUCache
 from enum import IntEnum
 
 
@@ -66,6 +70,50 @@ def test_full_select(demo_db):
     assert results[0]['SUM(hits)'] == 197 + 173
 
 
+def test_row_factories(demo_db):
+    row = demo_db.select_one('batters', ['name', 'hits'], {'year': 1999}, row_factory='tuple')
+    assert row == ('Olerud', 173)
+
+    row = demo_db.select_one('batters', ['name', 'hits'], {'year': 1999}, row_factory='namedtuple')
+    assert row.name == 'Olerud'
+    assert row[1] == 173
+
+    rows = demo_db.select('batters', ['name', 'SUM(hits)'], grouping='name', order='name', row_factory='record')
+    assert rows[0].name == 'Alfonzo'
+    assert rows[0]['SUM(hits)'] == 155 + 191 + 176
+    assert rows[0]._1 == 155 + 191 + 176
+    assert list(rows[0].keys()) == ['name', 'SUM(hits)']
+    assert 'name' in rows[0]
+    assert rows[0].get('year') is None
+    assert str(rows[0]) == "{'name': 'Alfonzo', 'SUM(hits)': 522}"
+    assert not hasattr(rows[0], '__dict__')
+
+    # Classes are reused for the same columns
+    assert type(rows[0]) is type(demo_db.select_one('batters', ['name', 'SUM(hits)'], row_factory='record'))
+
+    with pytest.raises(DatabaseError):
+        demo_db.select_one('batters', row_factory='dict')
+
+
+def test_default_row_factory():
+    db = SQLiteDB(pathlib.Path('record.db'), default_type='int', row_factory='record')
+    db.tables['people'] = ['id', 'name', 'age']
+    db.field_types['name'] = 'str'
+    db.update_database_structure()
+    db.insert('people', {'name': 'David', 'age': 40})
+    db.update('people', {'id': 1, 'age': 41})
+
+    person = db.select_one('people')
+    assert type(person).__name__ == 'People'
+    assert (person.id, person.name, person.age) == (1, 'David', 41)
+    assert db.table_as_dict('people')[1].age == 41
+    assert db.dict_lookup('name', 'age', 'people') == {'David': 41}
+    db.dispose()
+
+    with pytest.raises(DatabaseError):
+        SQLiteDB(pathlib.Path('record.db'), row_factory='dict')
+
+
 def test_lookup_all(demo_db):
     # Explicitly convert results to list
     # Test from before FlexibleIterator was implemented
@@ -102,6 +150,201 @@ def test_lookup_all_without_cast(demo_db):
     assert len(values) == 3
 
 
+def test_select_columns(demo_db):
+    columns = demo_db.select_columns('batters', ['name', 'year', 'hits'], {'name': 'Piazza'}, use_numpy=False)
+    assert columns['name'] == ['Piazza', 'Piazza', 'Piazza']
+    assert isinstance(columns['year'], array.array)
+    assert list(columns['year']) == [1998, 1999, 2000]
+    assert columns['year'].typecode == 'q'
+    assert sum(columns['hits']) == 137 + 162 + 156
+
+    columns = demo_db.select_columns('batters', chunk_size=2, use_numpy=False)
+    assert list(columns.keys()) == ['id', 'name', 'year', 'hits', 'position']
+    assert len(columns['id']) == 9
+
+    # NULL values
+    demo_db.insert('batters', {'name': 'Ventura'})
+    columns = demo_db.select_columns('batters', ['year'], use_numpy=False)
+    assert columns['year'][-1] is None
+    assert isinstance(columns['year'], list)
+
+    demo_db.field_types['hits'] = 'float'
+    columns = demo_db.select_columns('batters', 'hits', {'name': 'Ventura'}, use_numpy=False)
+    assert columns['hits'].typecode == 'd'
+    assert math.isnan(columns['hits'][0])
+
+
+def test_select_numpy_columns(demo_db):
+    numpy = pytest.importorskip('numpy')
+    columns = demo_db.select_columns('batters', ['year', 'hits'], 'WHERE year > 2010')
+    assert columns['year'].dtype == numpy.int64
+    assert len(columns['hits']) == 0
+
+    columns = demo_db.select_columns('batters', ['year', 'hits'])
+    assert columns['hits'].sum() == 1493
+
+
+def total_hits(rows):
+    return sum(row['hits'] for row in rows)
+
+
+def test_parallel_map(demo_db):
+    assert demo_db.parallel_map('batters', total_hits, workers=2, reduce=operator.add) == 1493
+    assert demo_db.parallel_map('batters', total_hits, {'name': 'Piazza'}, workers=2, reduce=operator.add) == 455
+
+    results = demo_db.parallel_map('batters', len, 'WHERE year > 1998', workers=2, fields='id', batches=3)
+    assert results == [0, 3, 3]
+
+    with pytest.raises(DatabaseError):
+        demo_db.parallel_map('batters', len, 'ORDER BY year')
+
+    demo_db.delete('batters')
+    assert demo_db.parallel_map('batters', len) == []
+
+
+def test_result_cache(demo_db):
+    demo_db.enable_result_cache(10)
+    assert demo_db.count('batters') == 9
+    assert demo_db.lookup('hits', 'batters', {'name': 'Zeile'}) == 146
+    assert demo_db.lookup('hits', 'batters', {'name': 'Zeile'}) == 146
+    assert demo_db.lookup('hits', 'batters', {'name': 'Franco'}) is None
+    assert demo_db.lookup('hits', 'batters', {'name': 'Franco'}) is None
+    assert demo_db.result_cache.hits == 2
+
+    # The results are copies
+    counts = demo_db.unique_counts('batters', 'name')
+    counts['Piazza'] = 0
+    assert demo_db.unique_counts('batters', 'name')['Piazza'] == 3
+    rows = demo_db.table_as_dict('batters')
+    assert rows[1]['name'] == 'Olerud'
+    assert demo_db.table_as_dict('batters') == rows
+
+    # Writing to the table removes the results
+    demo_db.insert('batters', {'name': 'Franco', 'year': 2000, 'hits': 57})
+    assert demo_db.count('batters') == 10
+    assert demo_db.lookup('hits', 'batters', {'name': 'Franco'}) == 57
+    assert demo_db.unique_counts('batters', 'name')['Franco'] == 1
+    demo_db.update('batters', {'id': 10, 'hits': 58})
+    assert demo_db.lookup('hits', 'batters', {'name': 'Franco'}) == 58
+    demo_db.execute('UPDATE OR IGNORE "batters" SET hits=59 WHERE id=10')
+    assert demo_db.lookup('hits', 'batters', {'name': 'Franco'}) == 59
+    demo_db.delete('batters', {'name': 'Franco'})
+    assert demo_db.count('batters') == 9
+    assert len(demo_db.table_as_dict('batters')) == 9
+
+    # Rolled back changes
+    with pytest.raises(ZeroDivisionError):
+        with demo_db.transaction():
+            demo_db.delete('batters')
+            assert demo_db.count('batters') == 0
+            1 / 0
+    assert demo_db.count('batters') == 9
+
+    # Only some tables
+    demo_db.enable_result_cache(10, tables=['other'])
+    demo_db.count('batters')
+    assert len(demo_db.result_cache) == 0
+
+    demo_db.disable_result_cache()
+    assert demo_db.count('batters') == 9
+
+
+def test_instrumentation(demo_db, caplog):
+    assert demo_db.stats() is None
+    calls = []
+    demo_db.enable_instrumentation(slow_query_threshold=0.0, hook=lambda *args: calls.append(args))
+
+    demo_db.lookup('hits', 'batters', {'name': 'Zeile'})
+    demo_db.lookup('hits', 'batters', {'name': 'Olerud'})
+    demo_db.query_one('SELECT hits FROM batters WHERE year = 1999 AND name = \'Piazza\'')
+    demo_db.bulk_insert('batters', ['name', 'year', 'hits'], [('Franco', 2001, 57), ('Bordick', 2001, 47)])
+    demo_db.execute('DELETE FROM batters WHERE year = 2001')
+
+    stats = demo_db.stats()
+    lookup = stats['SELECT hits FROM batters WHERE name=?']
+    assert lookup['count'] == 2
+    assert lookup['rows'] == 2
+    assert 0 <= lookup['p50'] <= lookup['p99'] <= lookup['total']
+    assert stats['SELECT hits FROM batters WHERE year = ? AND name = ?']['count'] == 1
+    assert stats['INSERT INTO batters (name, year, hits) VALUES(?, ...)']['rows'] == 2
+    assert stats['DELETE FROM batters WHERE year = ?']['rows'] == 2
+    assert len(calls) == 5
+    assert calls[0][1] == ('Zeile',)
+    assert 'Slow query' in caplog.text
+
+    # Lazily read rows are recorded once they have all been read
+    calls.clear()
+    results = demo_db.select('batters', ['name', 'hits'], order='hits')
+    assert 'SELECT name, hits FROM batters ORDER BY hits' not in demo_db.stats()
+    assert len(list(results)) == 9
+    assert demo_db.stats()['SELECT name, hits FROM batters ORDER BY hits']['rows'] == 9
+    assert [call[1:] for call in calls] == [((), calls[0][2], 9)]
+
+    demo_db.disable_instrumentation()
+    demo_db.count('batters')
+    assert demo_db.stats() is None
+    assert len(calls) == 1
+
+
+def test_explain(demo_db, caplog):
+    plan = demo_db.explain('batters', clause={'name': 'Piazza'})
+    assert len(plan) == 1
+    assert plan[0]['detail'] == 'SCAN batters'
+    assert plan[0]['children'] == []
+
+    demo_db.indexes['batters'] = ['name']
+    demo_db.update_database_structure()
+    assert demo_db.explain('batters', clause={'name': 'Piazza'})[0]['detail'].startswith('SEARCH batters USING INDEX')
+    subquery_plan = demo_db.get_query_plan('SELECT * FROM batters WHERE hits IN (SELECT MAX(hits) FROM batters)')
+    assert any(node['children'] for node in subquery_plan)
+
+    # Small tables are not reported
+    demo_db.enable_strict_mode(min_rows=100)
+    assert demo_db.count('batters', {'year': 1999}) == 3
+    assert 'Full scan' not in caplog.text
+
+    demo_db.enable_strict_mode(min_rows=5)
+    assert len(list(demo_db.select('batters', clause={'name': 'Piazza'}))) == 3
+    assert demo_db.count('batters', {'year': 1999}) == 3
+    assert 'Full scan of batters (9 rows)' in caplog.text
+
+    demo_db.enable_strict_mode(min_rows=5, raise_errors=True)
+    assert demo_db.lookup('hits', 'batters', {'name': 'Zeile'}) == 146
+    assert len(list(demo_db.select('batters'))) == 9
+    with pytest.raises(DatabaseError):
+        demo_db.delete('batters', {'year': 1999})
+    demo_db.enable_strict_mode(min_rows=10, raise_errors=True)
+    demo_db.delete('batters', {'year': 1999})
+
+    demo_db.disable_strict_mode()
+    assert demo_db.count('batters', {'year': 2000}) == 3
+
+
+def test_full_scan_detection(demo_db):
+    def step(detail, children=[]):
+        return {'id': 0, 'parent': 0, 'detail': detail, 'children': children}
+
+    def is_full_scan(*plan):
+        # Replace the plan for every query, and see if strict mode reports it
+        demo_db.get_query_plan = lambda query, params=(): list(plan)
+        demo_db.enable_strict_mode(min_rows=1, raise_errors=True)
+        try:
+            demo_db.select_one('batters', clause={'name': 'Piazza'})
+            return False
+        except DatabaseError:
+            return True
+
+    # Both the current and the older (before sqlite 3.36) plan formats
+    assert is_full_scan(step('SCAN batters'))
+    assert is_full_scan(step('SCAN TABLE batters'))
+    assert is_full_scan(step('SCAN TABLE batters AS b'))
+    assert is_full_scan(step('SEARCH players'), step('LIST SUBQUERY 1', [step('SCAN batters')]))
+    assert not is_full_scan(step('SCAN batters USING INDEX batters_name_idx'))
+    assert not is_full_scan(step('SCAN TABLE batters USING COVERING INDEX batters_name_idx'))
+    assert not is_full_scan(step('SEARCH TABLE batters USING INTEGER PRIMARY KEY (rowid=?)'))
+    assert not is_full_scan(step('SCAN players'))
+
+
 def test_lookup(demo_db):
     assert demo_db.lookup('hits', 'batters', {'year': 1999, 'name': 'Alfonzo'}) == 191
 
@@ -153,6 +396,27 @@ def test_table_as_dict(demo_db):
     assert d[Position.CATCHER]['name'] == 'Piazza'
     assert d[Position.SECOND_BASE]['name'] == 'Alfonzo'
 
+    # Added fields are at the end of the physical table, not where they are in the list of fields
+    demo_db.tables['batters'].insert(2, 'age')
+    demo_db.update_database_structure()
+    demo_db.update('batters', {'id': 1, 'age': 30})
+    d = demo_db.table_as_dict('batters', 'hits', row_factory='tuple')
+    assert d[197][-1] == 30
+    assert 30 not in d
+
+    # Tables that are not part of the structure
+    assert 'batters' in demo_db.table_as_dict('sqlite_master', 'name')
+
+    # The key's position comes from the query itself, without running another statement
+    calls = []
+    demo_db.enable_instrumentation(hook=lambda *args: calls.append(args))
+    demo_db.table_as_dict('batters', 'name')
+    assert [call[0].strip() for call in calls] == ['SELECT * FROM batters']
+    demo_db.disable_instrumentation()
+
+    with pytest.raises(DatabaseError):
+        demo_db.table_as_dict('batters', 'nickname')
+
 
 def test_unique_counts(demo_db):
     d = demo_db.unique_counts('batters', 'name')
@@ -214,6 +478,30 @@ def test_bulk_insert(demo_db):
         ])
 
 
+def test_streaming_bulk_insert(demo_db):
+    demo_db.write()
+    other_db = SQLiteDB(pathlib.Path('demo.db'))
+
+    progress = []
+
+    def generate_rows():
+        for year in range(2001, 2011):
+            # Each chunk is committed before the next is read
+            assert other_db.count('batters') == 9 + (year - 2001) // 4 * 4
+            yield 'Wright', year, 150
+
+    n = demo_db.bulk_insert('batters', ['name', 'year', 'hits'], generate_rows(), chunk_size=4, commit_every=4,
+                            progress=progress.append)
+    assert n == 10
+    assert progress == [4, 8, 10]
+    assert demo_db.count('batters') == 19
+    assert other_db.count('batters') == 17
+
+    assert demo_db.bulk_insert('batters', ['name'], []) == 0
+    assert demo_db.bulk_insert('batters', ['name'], [('Reyes',)] * 5, chunk_size=None) == 5
+    other_db.close(print_table_sizes=False)
+
+
 def test_update(demo_db):
     # No match, just insert
     assert demo_db.count('batters') == 9
@@ -236,6 +524,42 @@ def test_update(demo_db):
     assert demo_db.lookup('hits', 'batters', {'name': 'Zeile'}) == 4
 
 
+def test_bulk_update(demo_db):
+    demo_db.bulk_update('batters', ['id', 'name', 'year', 'hits'], [
+        (4, 'Olerud', 1999, 334),
+        (10, 'McEwing', 2000, 34),
+    ])
+    assert demo_db.count('batters') == 10
+    assert demo_db.lookup('hits', 'batters', 4) == 334
+    assert demo_db.lookup('name', 'batters', 10) == 'McEwing'
+    assert demo_db.lookup('position', 'batters', 4) == Position.FIRST_BASE
+
+    # Composite replace key
+    demo_db.delete('batters', {'year': 2000})
+    demo_db.bulk_update('batters', ['name', 'year', 'hits'], [
+        ('Piazza', 1999, 5),
+        ('Piazza', 2000, 156),
+        ('Alfonzo', 2000, 176),
+    ], ['name', 'year'])
+    assert demo_db.count('batters') == 8
+    assert demo_db.lookup('hits', 'batters', {'name': 'Piazza', 'year': 1999}) == 5
+    assert demo_db.lookup('hits', 'batters', {'name': 'Piazza', 'year': 2000}) == 156
+    index_sql = demo_db.lookup('sql', 'sqlite_master', {'name': 'batters_upsert_name_year'})
+    assert index_sql == 'CREATE UNIQUE INDEX batters_upsert_name_year ON batters(name, year)'
+
+    # Existing unique index is reused
+    demo_db.bulk_update('batters', ['year', 'name'], [(1998, 'Olerud'), (2001, 'Olerud')], ['name', 'year'])
+    assert demo_db.count('batters') == 9
+    assert demo_db.count('sqlite_master', {'type': 'index'}) == 1
+
+    with pytest.raises(DatabaseError):
+        demo_db.bulk_update('batters', ['name', 'hits'], [('Olerud', 1)], ['name', 'year'])
+
+    with pytest.raises(DatabaseError):
+        # Duplicate names prevent the unique index from being created
+        demo_db.bulk_update('batters', ['name', 'hits'], [('Olerud', 1)], 'name')
+
+
 def test_unique_insert(demo_db):
     assert demo_db.count('batters') == 9
     b_id = demo_db.unique_insert('batters', {'name': 'Olerud', 'year': 1998})
@@ -246,6 +570,64 @@ def test_unique_insert(demo_db):
     assert demo_db.count('batters') == 10
 
 
+def test_bulk_unique_insert(demo_db):
+    assert demo_db.count('batters') == 9
+    fields = ['name', 'year', 'position']
+    rows = [
+        ('Olerud', 1998, Position.FIRST_BASE),
+        ('Piazza', 2001, Position.CATCHER),
+        ('Piazza', 2001, Position.CATCHER),
+        ('Ventura', 2001, None),
+        ('Ventura', 2001, None),
+    ]
+    assert demo_db.bulk_unique_insert('batters', fields, rows) is None
+    assert demo_db.count('batters') == 11
+    assert demo_db.lookup('id', 'batters', {'name': 'Piazza', 'year': 2001}) == 10
+    assert demo_db.lookup('id', 'batters', {'name': 'Ventura'}) == 11
+
+    # Generator input with ids returned
+    ids = demo_db.bulk_unique_insert('batters', fields, (row for row in rows + [('Agbayani', 2001, None)]),
+                                     return_ids=True)
+    assert demo_db.count('batters') == 12
+    assert ids == {
+        ('Olerud', 1998, Position.FIRST_BASE): 1,
+        ('Piazza', 2001, Position.CATCHER): 10,
+        ('Ventura', 2001, None): 11,
+        ('Agbayani', 2001, None): 12,
+    }
+
+    with pytest.raises(DatabaseError):
+        demo_db.bulk_unique_insert('batters', ['name', 'year', 'hits', 'doubles', 'triples', 'position'], [])
+
+
+def test_bulk_unique_insert_plan(demo_db):
+    # Record the plans of the statements while the staging table still exists
+    plans = []
+
+    def flatten(nodes):
+        return [detail for node in nodes for detail in [node['detail']] + flatten(node['children'])]
+
+    def check_plan(query, params, seconds, rows):
+        if query.startswith(('INSERT INTO batters', 'SELECT MIN')):
+            plans.append(flatten(demo_db.get_query_plan(query, params)))
+    demo_db.enable_instrumentation(hook=check_plan)
+
+    rows = [(f'Player {i}', 2000 + i % 3, i % 5) for i in range(7000)] * 3
+    ids = demo_db.bulk_unique_insert('batters', ['name', 'year', 'hits'], rows, return_ids=True)
+    assert demo_db.count('batters') == 9 + 7000
+    assert demo_db.bulk_unique_insert('batters', ['name', 'year', 'hits'], rows) is None
+    assert demo_db.count('batters') == 9 + 7000
+    assert ids[rows[0]] == 10
+    assert ids[rows[6999]] == 7009
+    demo_db.disable_instrumentation()
+
+    # The existing rows are only scanned once, and the staged rows are found with the index
+    assert len(plans) == 3
+    for plan in plans:
+        assert sum(detail in ['SCAN batters', 'SCAN t'] for detail in plan) == 1
+        assert any('USING COVERING INDEX batters_staging_fields' in detail for detail in plan)
+
+
 def test_deletion(demo_db):
     assert demo_db.count('batters') == 9
     demo_db.delete('batters', 'WHERE name NOT LIKE "%z%"')
@@ -284,6 +666,51 @@ def test_none(demo_db):
     assert demo_db.count('batters', clause=clause) == 1
 
 
+def test_parameterized_clause(demo_db):
+    clause, params = demo_db.generate_clause({'year': 1999, 'name': 'O\'Brien', 'hits': None}, parameterized=True)
+    assert clause == 'WHERE year=? AND name=? AND hits IS NULL'
+    assert params == (1999, 'O\'Brien')
+
+    assert demo_db.generate_clause({}, parameterized=True) == ('', ())
+    assert demo_db.generate_clause(3, table='batters', full=False, parameterized=True) == ('id=?', (3,))
+
+    query, params = demo_db.generate_select_query('batters', 'hits', {'name': 'Piazza', 'year': 2000},
+                                                  parameterized=True)
+    assert query == 'SELECT hits FROM batters WHERE name=? AND year=?'
+    assert params == ('Piazza', 2000)
+    assert demo_db.query_one(query, params)['hits'] == 156
+
+    # Values with both kinds of quotes no longer need escaping
+    demo_db.insert('batters', {'name': '"Pudge" O\'Rourke', 'year': 2001, 'hits': 1})
+    assert demo_db.lookup('year', 'batters', {'name': '"Pudge" O\'Rourke'}) == 2001
+    demo_db.delete('batters', {'name': '"Pudge" O\'Rourke'})
+    assert demo_db.count('batters') == 9
+
+
+def test_query_cache(demo_db):
+    demo_db.query_cache = LRUCache(2)
+    for name in ['Olerud', 'Piazza', 'Alfonzo']:
+        demo_db.lookup('hits', 'batters', {'name': name, 'year': 1999})
+    assert demo_db.query_cache.misses == 1
+    assert demo_db.query_cache.hits == 2
+    assert len(demo_db.query_cache) == 1
+
+    # Different shapes are cached separately
+    assert demo_db.lookup('hits', 'batters', {'name': None, 'year': 1999}) is None
+    assert demo_db.lookup('name', 'batters', 7) == 'Zeile'
+    assert demo_db.query_cache.misses == 3
+    assert len(demo_db.query_cache) == 2
+
+    # Least recently used shape was evicted
+    demo_db.lookup('hits', 'batters', {'name': 'Olerud', 'year': 1999})
+    assert demo_db.query_cache.misses == 4
+    assert len(demo_db.query_cache) == 2
+
+    # Primary key clauses share the template for the equivalent dictionary
+    assert demo_db.lookup('name', 'batters', {'id': 8}) == 'Piazza'
+    assert demo_db.query_cache.misses == 4
+
+
 def test_fieldtypes(demo_db):
     assert demo_db.get_field_type('id') == 'INTEGER'
     assert demo_db.get_field_type('name') == 'TEXT'